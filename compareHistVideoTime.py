@@ -1,5 +1,6 @@
 import numpy as np
 import fileops
+import histindex
 import cv2
 import os
 import sys
@@ -43,6 +44,11 @@ thresholdFrac = 0.15
 # Pixel value diff threshold
 thresholdValue = 3
 
+# Only answer the query for frames between these times (in seconds into the video, both included)
+# Set to None to query the whole video.
+queryStart = None
+queryEnd = None
+
 
 ###############
 ## Parameters for raw video decompressor. Must fit precomputed data for histograms.
@@ -67,39 +73,90 @@ fileframes = "1"
 layout = "linear"
 compression = "zlib-6"
 
+# The query is answered this many more times on a single-file index, as a dashboard repeating its alert rules would.
+# Decompressed blocks are then served from a cache of (at most) cacheBytes bytes (see histindex.BlockCache).
+cachedRepeats = 5
+cacheBytes = 256*1024*1024
+
+inputVideoPath=os.path.join(inDir, inFileName)
+capture = cv2.VideoCapture(inputVideoPath)
+
+# Detect length of video to stop it looping. This is a workaround from normal because the Mac can't detect the end of file (so it loops the video)
+frames = capture.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT)
+fps = capture.get(cv2.cv.CV_CAP_PROP_FPS)
+vidWidth = int(capture.get(cv2.cv.CV_CAP_PROP_FRAME_WIDTH))
+vidHeight = int(capture.get(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT))
+
+# Range of frames to answer the query for, by both the histograms and the video
+firstFrame = int(round(queryStart*fps)) if queryStart is not None else 0
+lastFrame = int(round(queryEnd*fps)) if queryEnd is not None else frames
+
 # Naming for stored histogram folder
 print "HISTOGRAMS"
 tt = time.time()
 
 fmatches = []
+index = None
+inputIndexFile=histindex.indexName(os.path.join(inDir, "diff-"+inFileName+"_"+str(diffInterval)), fileframes, regSize, layout, compression)
 inputHistogramPath=os.path.join(inDir, "diff-"+inFileName+"_"+str(diffInterval), "frames_"+fileframes, str(regSize), layout, compression)
-dirlist = os.listdir(inputHistogramPath)
-i = 0
-for ff in dirlist:
-	i+=1
-	
-	print "File: {}".format(i * diffInterval)
-	
-	filepath = os.path.join(inputHistogramPath, ff)
-	
-	match = fileops.queryOnCompressedHistogram(filepath, regSize, queryArea, thresholdValue, thresholdFrac)
-	if match:
-		fmatches.append(i*diffInterval)
+if os.path.isfile(inputIndexFile):
+	# Single-file index (diffcompress.py --index): no directory scan, blocks are read through the offset table
+	# Only the blocks overlapping the query range are decompressed
+	cache = histindex.BlockCache(cacheBytes)
+	index = histindex.IndexReader(inputIndexFile, cache)
+	if index.blockCount() == 0:
+		print "Index {} holds no blocks".format(inputIndexFile)
+	else:
+		first = index.timestampAt(queryStart) if queryStart is not None else index.firsts[0]
+		last = index.timestampAt(queryEnd) if queryEnd is not None else index.lasts[-1]
+		fmatches = histindex.queryRange(index, first, last, queryArea, thresholdValue, thresholdFrac)
+		print "Blocks skipped using summaries: {} of {}".format(index.blocksSkipped, len(index.blocksInRange(first, last)))
+else:
+	# Files are numbered in the order their diffs were made. Files are named by the first diff they hold (see diffcompress.py).
+	def fileTimestamp(name):
+		info = fileops.diffFileInfo(name.partition(".hist")[0])
+		if info is None:
+			return -1
+		return info[3]
+	dirlist = sorted(os.listdir(inputHistogramPath), key=lambda n: (fileTimestamp(n), n))
+	i = 0
+	for ff in dirlist:
+		i+=1
+
+		# Skip files holding no frames in the query range
+		fileFirst = ((i-1)*int(fileframes) + 1)*diffInterval
+		fileLast = i*int(fileframes)*diffInterval
+		if fileLast < firstFrame or fileFirst > lastFrame:
+			continue
+		
+		print "File: {}".format(i * diffInterval)
+		
+		filepath = os.path.join(inputHistogramPath, ff)
+		
+		# Files hold int(fileframes) frames each (the last one may hold fewer), answered together
+		matches = fileops.queryOnCompressedHistogram(filepath, regSize, queryArea, thresholdValue, thresholdFrac, vidWidth, vidHeight)
+		for k in np.flatnonzero(matches):
+			frame = int(((i-1)*int(fileframes) + k + 1)*diffInterval)
+			if firstFrame <= frame <= lastFrame:
+				fmatches.append(frame)
 
 timeHistograms = time.time() - tt
 print "Histogram time: {}".format(timeHistograms)
 
+timeCached = None
+if index is not None:
+	if index.blockCount() > 0 and cachedRepeats > 0:
+		tt = time.time()
+		for r in range(0, cachedRepeats):
+			histindex.queryRange(index, first, last, queryArea, thresholdValue, thresholdFrac)
+		timeCached = (time.time() - tt) / cachedRepeats
+		print "Cached histogram time: {} ({} hits, {} misses, {} evictions)".format(timeCached, cache.hits, cache.misses, cache.evictions)
+	index.close()
+
 ################################
 # Perform query directly on video
 ################################
 print "VIDEO"
-inputVideoPath=os.path.join(inDir, inFileName)
-capture = cv2.VideoCapture(inputVideoPath)
-
-# Detect length of video to stop it looping. This is a workaround from normal because the Mac can't detect the end of file (so it loops the video)
-frames = capture.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT)
-fps = capture.get(cv2.cv.CV_CAP_PROP_FPS)
-
 tt = time.time()
 
 count = 1
@@ -119,12 +176,14 @@ while count <= frames:
 	graySecond = cv2.cvtColor(second, cv2.COLOR_BGR2GRAY)
 
 	print "File: {}".format(count)
+	if count > lastFrame:
+		break
 
 	# Absolute difference
 	diff = cv2.absdiff(graySecond, grayFirst)
 	
 	# Calculate histograms from data
-	match = fileops.queryOnData(diff, regSize, queryArea, thresholdValue, thresholdFrac)
+	match = count >= firstFrame and fileops.queryOnData(diff, regSize, queryArea, thresholdValue, thresholdFrac)
 	if match:
 		matches.append(count)
 	
@@ -141,9 +200,12 @@ fileframes: {}\n \
 compression: {}\n \
 framerate: {}\n \
 thresholdValue: {}\n \
-thresholdFraction: {}\n\n\n".format(inFileName, regSize, layout, fileframes, compression, diffInterval, thresholdValue, thresholdFrac)
+thresholdFraction: {}\n \
+queryRange: {} - {}\n\n\n".format(inFileName, regSize, layout, fileframes, compression, diffInterval, thresholdValue, thresholdFrac, queryStart, queryEnd)
 
 out += "Histogram time: {}\n".format(timeHistograms)
+if timeCached is not None:
+	out += "Cached histogram time: {}\n".format(timeCached)
 out += "    Video time: {}\n".format(timeVideo)
 out += "Histogram matches: \n{}\n\n".format(fmatches)
 out += "    Video matches: \n{}\n\n".format(matches)
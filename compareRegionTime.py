@@ -0,0 +1,75 @@
+import numpy as np
+import fileops
+import os
+import sys
+import time
+import argparse
+
+## Compare time spent computing region histograms for a diff frame.
+## 1: fileops.regionsFromData (one np.histogram call per region)
+## 2: fileops.regionsFromDataFast (region-ID map and a single bincount)
+## Both outputs are checked to be equal before timings are reported.
+
+## Parameters
+# Video resolution
+vidWidth = 1920
+vidHeight = 1080
+
+# Regions per direction
+regSizes = [4, 8, 16, 32]
+
+# Number of diff frames to time each function on
+repeats = 10
+
+# Cols = Different pixel values
+cols = 256
+
+
+parser = argparse.ArgumentParser(description='Arguments')
+parser.add_argument('--height', dest='height', type=int, action='store', default=vidHeight, help='the height of the original video')
+parser.add_argument('--width', dest='width', type=int, action='store', default=vidWidth, help='the width of the original video')
+parser.add_argument('--regions', dest='regions', type=int, action='store', default=regSizes, nargs='+', help='a list of regions per direction')
+parser.add_argument('--repeats', dest='repeats', type=int, action='store', default=repeats, help='the number of diff frames to time')
+parser.add_argument('--dir', dest='pp', action='store', help='directory containing diffs to use (random diffs are generated if not given)')
+
+args = parser.parse_args()
+vidHeight = args.height
+vidWidth = args.width
+regSizes = args.regions
+repeats = args.repeats
+
+# Read diffs from disk if a directory is given, otherwise generate diffs looking roughly like surveillance footage (mostly small values)
+diffs = []
+if args.pp:
+	dirlist = sorted([f for f in os.listdir(args.pp) if f.endswith(".bin")])[:repeats]
+	for ff in dirlist:
+		diffs.append(fileops.dataFromFile(os.path.join(args.pp, ff), vidWidth, vidHeight))
+else:
+	for n in range(0, repeats):
+		diffs.append(np.minimum(np.random.gamma(1.5, 4., (vidHeight, vidWidth)), cols-1).astype(np.ubyte))
+
+if len(diffs) == 0:
+	print "No diffs found in {}".format(args.pp)
+	sys.exit(0)
+
+out = "Resolution: {}x{}, diffs: {}\n".format(vidWidth, vidHeight, len(diffs))
+out += "Regions, regionsFromData (s/frame), regionsFromDataFast (s/frame), Speedup\n"
+for regSize in regSizes:
+	tt = time.time()
+	for data in diffs:
+		slowHist = fileops.regionsFromData(data, regSize, cols)
+	timeSlow = (time.time() - tt) / len(diffs)
+
+	# First call builds the region-ID map for this geometry, which is then reused for all frames.
+	tt = time.time()
+	for data in diffs:
+		fastHist = fileops.regionsFromDataFast(data, regSize, cols)
+	timeFast = (time.time() - tt) / len(diffs)
+
+	if not np.array_equal(slowHist, fastHist):
+		print "Histograms differ for {} regions!".format(regSize*regSize)
+		sys.exit(1)
+
+	out += "{:>7}, {:>25.5f}, {:>29.5f}, {:>7.1f}\n".format(regSize*regSize, timeSlow, timeFast, timeSlow/timeFast)
+
+print out
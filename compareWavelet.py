@@ -0,0 +1,124 @@
+import numpy as np
+import fileops
+import compressors
+import os
+import sys
+import time
+import argparse
+
+## Compare the lossy wavelet layout with the lossless layouts, on region histograms of diff frames.
+## For every region size, blocks of frames are stored with every layout and compressed with every codec:
+## 1: lossless layouts (fileops.layoutAxes, fileops.transformLayouts, fileops.truncatedLayouts)
+## 2: the wavelet layout (fileops.waveletLayouts) with every wavelet and budget
+## Reported are the compressed size, the time spent storing and compressing (encode) and decompressing and reading (decode)
+## per frame, and for wavelets the mean error bound and the mean error of the # pixels below the threshold values,
+## both as a percentage of the pixels in a region. Lossless layouts are checked to read back exactly.
+
+## Parameters
+# Video resolution
+vidWidth = 1920
+vidHeight = 1080
+
+# Regions per direction
+regSizes = [4, 8, 16]
+
+# Frames per block
+frames = 10
+
+# Number of diff frames to use
+repeats = 50
+
+# Lossless layouts and codecs to compare with
+layouts = ["linear", "truncated-delta", "varint"]
+codecs = ["zlib-6", "zstd-3", "lzma"]
+
+# Wavelets and budgets (coefficients kept per region histogram) to try
+wavelets = ["haar", "db2"]
+budgets = [8, 16, 32]
+
+# Threshold values the error of the # pixels below them is measured at
+thresholdValues = [5, 10, 20, 40, 80]
+
+# Cols = Different pixel values
+cols = 256
+
+
+parser = argparse.ArgumentParser(description='Arguments')
+parser.add_argument('--height', dest='height', type=int, action='store', default=vidHeight, help='the height of the original video')
+parser.add_argument('--width', dest='width', type=int, action='store', default=vidWidth, help='the width of the original video')
+parser.add_argument('--regions', dest='regions', type=int, action='store', default=regSizes, nargs='+', help='a list of regions per direction')
+parser.add_argument('--frames', dest='frames', type=int, action='store', default=frames, help='the number of frames per block')
+parser.add_argument('--repeats', dest='repeats', type=int, action='store', default=repeats, help='the number of diff frames to use')
+parser.add_argument('--layouts', dest='layouts', action='store', default=layouts, nargs='+', help='a list of lossless layouts to compare with')
+parser.add_argument('--codecs', dest='codecs', action='store', default=codecs, nargs='+', help='a list of codecs to compress with (see compressors.py). Codecs that are not installed are skipped')
+parser.add_argument('--wavelets', dest='wavelets', action='store', default=wavelets, nargs='+', help='a list of wavelets (see pywt.wavelist) to try')
+parser.add_argument('--budgets', dest='budgets', type=int, action='store', default=budgets, nargs='+', help='a list of numbers of coefficients kept per region histogram to try')
+parser.add_argument('--dir', dest='pp', action='store', help='directory containing diffs to use (random diffs are generated if not given)')
+
+args = parser.parse_args()
+vidHeight = args.height
+vidWidth = args.width
+regSizes = args.regions
+frames = args.frames
+repeats = args.repeats
+codecs = [compressors.get(codec) for codec in compressors.available(args.codecs) if not compressors.isTrained(codec)]
+
+# Read diffs from disk if a directory is given, otherwise generate diffs looking roughly like surveillance footage (mostly small values)
+if args.pp:
+	dirlist = sorted([f for f in os.listdir(args.pp) if f.endswith(".bin")])[:repeats]
+	diffs = fileops.dataBatchFromFiles([os.path.join(args.pp, ff) for ff in dirlist], vidWidth, vidHeight) if len(dirlist) > 0 else []
+else:
+	diffs = np.minimum(np.random.gamma(1.5, 4., (repeats, vidHeight, vidWidth)), cols-1).astype(np.ubyte)
+
+if len(diffs) == 0:
+	print "No diffs found in {}".format(args.pp)
+	sys.exit(0)
+
+# Store the blocks of stack with the layout and compress them with the codec. Return the compressed size, the time spent
+# encoding and decoding, and the histograms and error bounds read back (error bounds are None for lossless layouts).
+def storeBlocks(stack, layout, codec, wavelet=None):
+	size = 0
+	timeEncode = 0.0
+	timeDecode = 0.0
+	hists = []
+	errors = []
+	for first in range(0, len(stack), frames):
+		block = stack[first:first+frames]
+		tt = time.time()
+		compressed = codec.compress(fileops.histLayoutArray(block, layout, wavelet).tobytes())
+		timeEncode += time.time() - tt
+		size += len(compressed)
+
+		tt = time.time()
+		bytes = codec.decompress(compressed)
+		if layout in fileops.waveletLayouts:
+			hist, error = fileops.waveletFromBytes(bytes, stack.shape[1], cols, stack.dtype)
+			errors.append(error)
+		else:
+			hist = fileops.histFromBytesLayout(bytes, layout, stack.shape[1], cols, stack.dtype)
+		timeDecode += time.time() - tt
+		hists.append(hist)
+	return size, timeEncode, timeDecode, np.concatenate(hists), np.concatenate(errors) if len(errors) > 0 else None
+
+out = "Resolution: {}x{}, diffs: {}, frames per block: {}\n".format(vidWidth, vidHeight, len(diffs), frames)
+out += "Regions, {:>16}, {:>8}, {:>10}, {:>18}, {:>18}, {:>15}, {:>15}\n".format("Layout", "Codec", "Size (kB)", "Encode (ms/frame)", "Decode (ms/frame)", "Mean bound (%)", "Mean error (%)")
+for regSize in regSizes:
+	stack = fileops.histToArray(fileops.regionsFromDataBatch(diffs, regSize, cols))
+	regionPixels = stack[:, :, -1].astype(np.float64)
+	variations = [(layout, None) for layout in args.layouts] + [("wavelet", (wavelet, budget)) for wavelet in args.wavelets for budget in args.budgets]
+	for layout, wavelet in variations:
+		for codec in codecs:
+			size, timeEncode, timeDecode, hists, errors = storeBlocks(stack, layout, codec, wavelet)
+			name = layout if wavelet is None else "{}-{}-{}".format(layout, *wavelet)
+			if errors is None:
+				if not np.array_equal(hists, stack):
+					print "Histograms stored with {} differ for {} regions!".format(layout, regSize*regSize)
+					sys.exit(1)
+				bound = error = 0.0
+			else:
+				bins = np.array(thresholdValues) - 1
+				bound = 100 * (errors / regionPixels).mean()
+				error = 100 * (np.abs(hists[:, :, bins].astype(np.int64) - stack[:, :, bins]) / regionPixels[:, :, np.newaxis]).mean()
+			out += "{:>7}, {:>16}, {:>8}, {:>10.1f}, {:>18.3f}, {:>18.3f}, {:>15.3f}, {:>15.3f}\n".format(regSize*regSize, name, codec.name, size/1024.0, 1000*timeEncode/len(stack), 1000*timeDecode/len(stack), bound, error)
+
+print out
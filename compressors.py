@@ -0,0 +1,209 @@
+import zlib as zlib
+import bz2 as bz2
+
+# Registry of the compression algorithms (codecs) histograms can be compressed with.
+#
+# Codecs are named by a family, optionally followed by a parameter, e.g. "zlib-6" or "zstd-19":
+#	zlib-N		zlib at level N (0-9)
+#	bz2-N		bzip2 with a block size of N*100 kB (1-9)
+#	lzma-N		LZMA (.lzma format) at preset N (0-9), using the standard library lzma module (or backports.lzma)
+#	xz-N		LZMA2 (.xz format) at preset N (0-9), as lzma-N
+#	zstd-N		Zstandard at level N (1-22), using the zstandard module
+#	zstddict-N	Zstandard at level N with a dictionary trained on samples of the data (see trainDictionary)
+#	lz4			LZ4 block compression
+#	snappy		Snappy
+# Families without a parameter use a default (see families), i.e. "lzma" is "lzma-6". lz4 and snappy take no parameter.
+# Codecs of trained families (see trainers) compress small inputs much better, but need the dictionary they were trained with
+# to both compress and decompress, so it must be stored with the compressed data.
+#
+# Libraries are optional. Codecs whose library isn't installed are reported by unavailable(), and skipped by available().
+
+try:
+	import lzma as lzma
+	if not hasattr(lzma, "FORMAT_ALONE"):
+		raise ImportError("lzma module is pyliblzma")
+except ImportError:
+	try:
+		from backports import lzma as lzma
+	except ImportError:
+		lzma = None
+
+try:
+	import zstandard as zstd
+except ImportError:
+	zstd = None
+
+try:
+	import lz4.block as lz4
+except ImportError:
+	try:
+		import lz4 as lz4
+	except ImportError:
+		lz4 = None
+
+try:
+	import snappy as snappy
+except ImportError:
+	snappy = None
+
+# Codecs used when none are given
+defaultCodecs = ["lz4", "snappy", "bz2-6", "zlib-6", "lzma"]
+
+
+# A codec: a name, and functions taking bytes and returning the compressed or decompressed bytes.
+# params holds the parameters the codec was made with (e.g. level).
+class Codec:
+	def __init__(self, name, compress, decompress, params=None):
+		self.name = name
+		self.compress = compress
+		self.decompress = decompress
+		self.params = params if params is not None else {}
+
+
+# Raise ValueError if the parameter of the codec with the given name isn't in the range low to high (both included)
+def checkRange(name, param, low, high):
+	if not low <= param <= high:
+		raise ValueError("Codec parameter of {} must be between {} and {}".format(name, low, high))
+
+def zlibCodec(name, level=6):
+	checkRange(name, level, 0, 9)
+	return Codec(name, lambda b: zlib.compress(b, level), zlib.decompress, {"level": level})
+
+def bz2Codec(name, level=6):
+	checkRange(name, level, 1, 9)
+	return Codec(name, lambda b: bz2.compress(b, level), bz2.decompress, {"level": level})
+
+def lzmaCodec(name, preset=6):
+	checkRange(name, preset, 0, 9)
+	if lzma is None:
+		raise ImportError("lzma needs the lzma module (Python 3) or backports.lzma")
+	return Codec(name, lambda b: lzma.compress(b, format=lzma.FORMAT_ALONE, preset=preset), lzma.decompress, {"preset": preset})
+
+def xzCodec(name, preset=6):
+	checkRange(name, preset, 0, 9)
+	if lzma is None:
+		raise ImportError("xz needs the lzma module (Python 3) or backports.lzma")
+	return Codec(name, lambda b: lzma.compress(b, format=lzma.FORMAT_XZ, preset=preset), lzma.decompress, {"preset": preset})
+
+# Zstandard codec. If dictionary (bytes) is given, data is compressed with it, and can only be decompressed with it.
+def zstdCodec(name, level=3, dictionary=None):
+	checkRange(name, level, 1, 22)
+	if zstd is None:
+		raise ImportError("zstd needs the zstandard module")
+	params = {"level": level}
+	if dictionary is None:
+		compressor = zstd.ZstdCompressor(level=level)
+		decompressor = zstd.ZstdDecompressor()
+	else:
+		params["dictionary"] = dictionary
+		dictionary = zstd.ZstdCompressionDict(dictionary)
+		compressor = zstd.ZstdCompressor(level=level, dict_data=dictionary)
+		decompressor = zstd.ZstdDecompressor(dict_data=dictionary)
+	return Codec(name, compressor.compress, decompressor.decompress, params)
+
+def lz4Codec(name):
+	if lz4 is None:
+		raise ImportError("lz4 needs the lz4 module")
+	return Codec(name, lz4.compress, lz4.decompress)
+
+def snappyCodec(name):
+	if snappy is None:
+		raise ImportError("snappy needs the snappy module")
+	return Codec(name, snappy.compress, snappy.decompress)
+
+# Return a dictionary of (at most) size bytes trained by zstd on a list of samples (byte strings)
+def trainZstdDictionary(samples, size):
+	if zstd is None:
+		raise ImportError("zstd needs the zstandard module")
+	try:
+		return zstd.train_dictionary(size, samples).as_bytes()
+	except zstd.ZstdError as e:
+		raise ValueError("Can't train a zstd dictionary on {} samples: {}".format(len(samples), e))
+
+# Functions making the codecs of every family, taking the codec name and the (integer) parameter if there is one
+families = {
+	"zlib": zlibCodec,
+	"bz2": bz2Codec,
+	"lzma": lzmaCodec,
+	"xz": xzCodec,
+	"zstd": zstdCodec,
+	"zstddict": zstdCodec,
+	"lz4": lz4Codec,
+	"snappy": snappyCodec
+}
+
+# Families that take no parameter
+parameterless = ["lz4", "snappy"]
+
+# Functions training the dictionaries of trained families, taking the samples and the dictionary size
+trainers = {
+	"zstddict": trainZstdDictionary
+}
+
+# Codecs made so far, by name (and dictionary, for trained codecs)
+codecs = {}
+
+# Return the family of the codec with the given name, and a list holding its parameter if it has one.
+# Raise ValueError for unknown names.
+def parse(name):
+	family, dash, param = name.partition("-")
+	if family not in families:
+		raise ValueError("Unknown codec {}".format(name))
+	if param == "":
+		return family, []
+	if family in parameterless:
+		raise ValueError("Codec {} takes no parameter, use {}".format(name, family))
+	if param.isdigit():
+		return family, [int(param)]
+	raise ValueError("Codec parameter of {} must be a number".format(name))
+
+# Return True if the codec with the given name needs a trained dictionary
+def isTrained(name):
+	return name.partition("-")[0] in trainers
+
+# Return the codec with the given name. Codecs of trained families also need the dictionary they were trained with.
+# Raise ValueError for unknown names, and ImportError if the library isn't installed.
+def get(name, dictionary=None):
+	key = name if dictionary is None else (name, dictionary)
+	if key in codecs:
+		return codecs[key]
+
+	family, params = parse(name)
+	if family in trainers:
+		if dictionary is None:
+			raise ValueError("Codec {} needs a trained dictionary (see trainDictionary)".format(name))
+		codec = families[family](name, *params, dictionary=dictionary)
+	else:
+		codec = families[family](name, *params)
+
+	codecs[key] = codec
+	return codec
+
+# Return a dictionary of (at most) size bytes for the trained codec with the given name, trained on a list of samples (byte strings)
+# like the data it will compress. Raise ValueError if the codec isn't trained or no dictionary can be trained (e.g. too few samples).
+def trainDictionary(name, samples, size=16*1024):
+	family, params = parse(name)
+	if family not in trainers:
+		raise ValueError("Codec {} doesn't use a dictionary".format(name))
+	return trainers[family](samples, size)
+
+# Register a codec (e.g. made by zstdCodec with a dictionary) under its name, so get returns it
+def register(codec):
+	codecs[codec.name] = codec
+	return codec
+
+# Return the codecs in names that can be used, in the same order
+def available(names):
+	return [name for name in names if name not in unavailable(names)]
+
+# Return a dictionary with the reason for every codec in names that can't be used.
+# Trained codecs are checked without a dictionary, i.e. only their library must be installed.
+def unavailable(names):
+	reasons = {}
+	for name in names:
+		try:
+			family, params = parse(name)
+			families[family](name, *params)
+		except (ImportError, ValueError) as e:
+			reasons[name] = str(e)
+	return reasons
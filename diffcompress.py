@@ -8,12 +8,16 @@ import copy as copy
 import wavecomp
 import mischist
 import fileops
+import histindex
+import compressors
 import Queue as queue
 import sys
 import os
 import argparse
+import collections
 from collections import namedtuple
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
+from fractions import gcd
 
 
 #####################################################
@@ -33,12 +37,38 @@ regSizes = [4, 8, 16, 32]
 # Frames per file
 frames = [1, 10]
 
+# Number of diffs read and histogrammed at once. Larger batches use more memory (about 9 bytes per pixel per diff).
+batchSize = 8
+
 # Layout we want to store the histograms with
 layouts = ["linear", "binned", "reg-linear", "reg-binned"]
 
-# Compression algorithms we are interested in trying out. 
-# The value defines how they are shown in graphs with matplotlib.
-compressions = {"lz4": "ro--", "snappy": "go--", "bz2-6": "bo--", "zlib-6": "ko--", "lzma": "mo--"}
+# Compression algorithms we are interested in trying out (see compressors.py for the codec names). 
+# The value defines how they are shown in graphs with matplotlib. Codecs given with --codecs and not listed here get the styles in otherStyles.
+compressions = {"lz4": "ro--", "snappy": "go--", "bz2-6": "bo--", "zlib-6": "ko--", "lzma": "mo--", "zstd-3": "co--", "zstddict-3": "yo--"}
+otherStyles = ["r^--", "g^--", "b^--", "k^--", "m^--", "c^--", "y^--"]
+
+# Trained codecs (e.g. zstddict-3) compress with a dictionary trained for every index variation on dictSamples diffs spread
+# over the recording. Dictionaries are at most dictSize bytes, and are stored once per variation (in index files and next to the compressed files).
+dictSamples = 100
+dictSize = 16*1024
+
+# Wavelet and number of coefficients kept per region histogram (budget) with the lossy wavelet layout (see fileops.waveletLayouts).
+# With wavelet "auto", both are chosen on the histograms of dictSamples diffs spread over the recording (see fileops.selectWavelet).
+wavelet = "haar"
+waveletBudget = 16
+
+# Worker processes compressing histograms, and the maximum number of tasks given to them at a time.
+# Bounding the tasks in flight bounds the memory used for histograms waiting to be compressed.
+processes = cpu_count()
+inFlight = 2*processes
+
+# Number of shards. With more than one shard, diffs are split in contiguous ranges that are each read, histogrammed
+# and compressed by a single worker, so histogramming is parallel too.
+shards = 1
+
+# Frame rate of the original video. Stored in indexes to convert the frame numbers of diffs to time.
+fps = 25.0
 
 # Debugging
 debug = False
@@ -54,8 +84,23 @@ parser.add_argument('--height', dest='height', type=int, action='store', default
 parser.add_argument('--width', dest='width', type=int, action='store', default=vidWidth, help='the width of the original video')
 parser.add_argument('--regions', dest='regions', type=int, action='store', default=regSizes, nargs='+', help='a list of regions per direction')
 parser.add_argument('--frames', dest='frames', type=int, action='store', default=frames, nargs='+', help='a list of # frames that should be stored per compressed file')
-parser.add_argument('--layouts', dest='layouts', choices=["linear", "binned", "reg-linear", "reg-binned"], action='store', default=layouts, nargs='+', help='a list of layouts names in which the regions should be stored')
+parser.add_argument('--layouts', dest='layouts', choices=["linear", "binned", "reg-linear", "reg-binned", "bin-delta", "frame-delta", "frame-xor", "varint", "frame-varint", "truncated", "truncated-delta", "wavelet"], action='store', default=layouts, nargs='+', help='a list of layouts names in which the regions should be stored')
 parser.add_argument('--dir', dest='pp', required=True, action='store', help='directory containing diffs to process')
+parser.add_argument('--codecs', dest='codecs', action='store', default=sorted(compressions.keys()), nargs='+', help='a list of codecs to compress with, e.g. zlib-9 bz2-6 lzma xz-6 zstd-3 lz4 snappy (see compressors.py). Codecs that are not installed are skipped')
+parser.add_argument('--dictsamples', dest='dictsamples', type=int, action='store', default=dictSamples, help='the number of diffs spread over the recording that dictionaries of trained codecs (e.g. zstddict-3) are trained on')
+parser.add_argument('--dictsize', dest='dictsize', type=int, action='store', default=dictSize, help='the maximum size in bytes of the dictionaries of trained codecs')
+parser.add_argument('--batch', dest='batch', type=int, action='store', default=batchSize, help='the number of diffs read and histogrammed at once')
+parser.add_argument('--index', dest='index', action='store_true', help='also write each index variation as a single index file (frames_N/regions/layout.compression.hidx)')
+parser.add_argument('--regionchunks', dest='regionchunks', action='store_true', help='compress every region separately in index files with reg-linear and reg-binned layouts')
+parser.add_argument('--satlevels', dest='satlevels', type=int, action='store', default=None, nargs='+', help='threshold values to store summed-area tables for in index files, for fast rectangular queries')
+parser.add_argument('--binedges', dest='binedges', type=int, action='store', default=None, nargs='+', help='threshold values to quantize the histograms in index files to; queries are exact at these values and bounded between them')
+parser.add_argument('--wavelet', dest='wavelet', action='store', default=wavelet, help='the wavelet (see pywt.wavelist) of the wavelet layout, or auto to choose the wavelet and budget on --dictsamples diffs')
+parser.add_argument('--budget', dest='budget', type=int, action='store', default=waveletBudget, help='the number of wavelet coefficients kept per region histogram with the wavelet layout')
+parser.add_argument('--fps', dest='fps', type=float, action='store', default=fps, help='the frame rate of the original video (stored in index files)')
+parser.add_argument('--processes', dest='processes', type=int, action='store', default=processes, help='the number of worker processes compressing histograms')
+parser.add_argument('--inflight', dest='inflight', type=int, action='store', default=None, help='the maximum number of compression tasks in flight (default: twice the number of processes)')
+parser.add_argument('--shards', dest='shards', type=int, action='store', default=shards, help='split the diffs in this many contiguous ranges, each read, histogrammed and compressed by one worker process')
+parser.add_argument('--pyramid', dest='pyramid', action='store_true', help='histogram only the finest region grid and sum it into the coarser grids (when they nest)')
 
 args = parser.parse_args()
 if debug:
@@ -65,6 +110,21 @@ if debug:
 	print "frames: "+str(args.frames)
 	print "layouts: "+str(args.layouts)
 	print "dir: "+args.pp
+	print "codecs: "+str(args.codecs)
+	print "dictsamples: "+str(args.dictsamples)
+	print "dictsize: "+str(args.dictsize)
+	print "pyramid: "+str(args.pyramid)
+	print "batch: "+str(args.batch)
+	print "index: "+str(args.index)
+	print "regionchunks: "+str(args.regionchunks)
+	print "satlevels: "+str(args.satlevels)
+	print "binedges: "+str(args.binedges)
+	print "wavelet: "+str(args.wavelet)
+	print "budget: "+str(args.budget)
+	print "fps: "+str(args.fps)
+	print "processes: "+str(args.processes)
+	print "inflight: "+str(args.inflight)
+	print "shards: "+str(args.shards)
 
 
 # Use the input arguments in place of the defaults (i.e. if they were changed, otherwise defaults are used)
@@ -73,6 +133,20 @@ vidWidth = args.width
 regSizes = args.regions
 frames = args.frames
 layouts = args.layouts
+pyramid = args.pyramid
+batchSize = args.batch
+fps = args.fps
+processes = args.processes
+inFlight = args.inflight if args.inflight is not None else 2*processes
+shards = args.shards
+wavelet = (args.wavelet, args.budget)
+
+# Skip codecs that can't be used, and give the remaining ones a style
+unavailable = compressors.unavailable(args.codecs)
+for codec, reason in sorted(unavailable.items()):
+	print "Skipping codec {}: {}".format(codec, reason)
+codecs = [codec for codec in args.codecs if codec not in unavailable]
+compressions = dict((codec, compressions[codec] if codec in compressions else otherStyles[k % len(otherStyles)]) for k, codec in enumerate(codecs))
 if os.path.isdir(args.pp):
 	pp = args.pp
 else:
@@ -150,24 +224,44 @@ def filterList(itemlist, filterlist):
 			yield r
 
 
-# Lists for storing several images worth of histograms, to experiment with compression of longer runs of data
-histograms = {}
-for f in frames:
-	histograms[f] = {}
+# Return a new dictionary for keeping timings: timings[regSize][i][layout]["individual"] holds the timings of every compression
+def newTimings():
+	timings = {}
+	for regSize in regSizes:
+		timings[regSize] = {}
+		for i in frames:
+			timings[regSize][i] = {}
+			for layout in layouts:
+				timings[regSize][i][layout] = {"individual": {}, "total": {}}
+	return timings
 
 # For keeping all timings. 
-allTimings = {}
-for regSize in regSizes:
-	allTimings[regSize] = {}
-	for i in frames:
-		histograms[i][regSize] = []
-		allTimings[regSize][i] = {}
-		for layout in layouts: 
-			allTimings[regSize][i][layout] = {"individual": {}, "total": {}}
+allTimings = newTimings()
 
-# Parallelization pool
-proc = 8
-pool = Pool(processes=proc)
+# Tasks given to the pool, oldest first, with the function handling their result. Results are handled in the order
+# the tasks were given, so index blocks are appended in order.
+tasks = collections.deque()
+
+# Handle the result of the oldest task, waiting for it to finish if needed
+def finishTask():
+	result, done = tasks.popleft()
+	done(result.get())
+
+# Give a task to the pool, first waiting for the oldest tasks if inFlight tasks are already in flight
+def submitTask(func, funcArgs, done):
+	while len(tasks) >= inFlight:
+		finishTask()
+	tasks.append((pool.apply_async(func, funcArgs), done))
+
+# Run a task in this process, as submitTask would in the pool (used by shards, which already run in the pool)
+def runTask(func, funcArgs, done):
+	done(func(*funcArgs))
+
+# Return a function appending a block with the given timestamps, made from the sections it is called with, to an index
+def appendSectionsFact(writer, blockTimestamps):
+	def appendSections(sections):
+		writer.appendSections(blockTimestamps, sections)
+	return appendSections
 
 # Ignore non-wanted files in dirlist and remove them to ensure correct operation
 dirlist = os.listdir(pp)
@@ -183,66 +277,263 @@ for ff in dirlist:
 		
 dirlist = [n for n in dirlist if n not in ignlist]
 
+# Diffs stored in diff packs are processed as if they were separate files, named as in the pack.
+# packFrames maps such a name to the pack and the index of the diff in it.
+packFrames = {}
+packlist = [n for n in dirlist if fileops.isDiffPack(n)]
+dirlist = [n for n in dirlist if not fileops.isDiffPack(n)]
+for packName in packlist:
+	packPath = os.path.join(pp, packName)
+	names, offsets = fileops.readDiffPack(packPath)
+	for idx, name in enumerate(names):
+		packFrames[name] = (packPath, idx)
+		dirlist.append(name)
+
+# Process diffs in the order they were made. Names of diffs written by vid2diff.py hold the frame number they were made from.
+def diffTimestamp(name):
+	info = fileops.diffFileInfo(name)
+	if info is None:
+		return -1
+	return info[3]
+dirlist = sorted(dirlist, key=lambda n: (diffTimestamp(n), n))
+
+if len(dirlist) == 0:
+	print "No diffs found in {}".format(pp)
+	sys.exit(0)
+
+# Return index writers for all index variations, writing to the files named by histindex.indexName followed by postfix
+def openIndexWriters(postfix=""):
+	writers = {}
+	for regSize in regSizes:
+		for i in frames:
+			fileops.ensureDir(os.path.join(pp, "frames_"+str(i), str(regSize)))
+			for layout in layouts:
+				for compression in compressions.keys():
+					writers[(i, regSize, layout, compression)] = histindex.IndexWriter(histindex.indexName(pp, i, regSize, layout, compression)+postfix, vidWidth, vidHeight, regSize, layout, compression, fps, i, cols, regionChunks=args.regionchunks and layout in histindex.regionLayouts, satLevels=args.satlevels, binEdges=args.binedges, dictionary=dictionaries.get((i, regSize, layout, compression)), wavelet=wavelet)
+	return writers
+
+# Return the trained dictionaries of the variation with i frames per file, regSize regions and the given layout, by codec
+def variationDictionaries(i, regSize, layout):
+	return dict((compression, dictionaries[(i, regSize, layout, compression)]) for compression in compressions.keys() if (i, regSize, layout, compression) in dictionaries)
+
 
 
 #####################################################
 ###### HERE STARTS THE ACTUAL COMPRESSION WORK ######
 #####################################################
 
-# Process all files in directory with the given region size
-filecount = 0
-for ff in dirlist:
-	# ignore directories
-	current_file = os.path.join(pp, ff)
-	filecount += 1
-	
-	# Read data from file (once!)
-	data = fileops.dataFromFile(current_file, vidWidth, vidHeight)
-	
-	# Iterate over different numbers of regions.
+# Read a batch of diffs (given by name) into a (N, height, width) array.
+# Diffs following each other in the same diff pack are memory mapped at once.
+def readBatch(batch):
+	if all(ff in packFrames for ff in batch):
+		packPath, start = packFrames[batch[0]]
+		if all(packFrames[ff] == (packPath, start+b) for b, ff in enumerate(batch)):
+			return fileops.dataBatchFromPack(packPath, vidWidth, vidHeight, start, len(batch))
+	if not any(ff in packFrames for ff in batch):
+		return fileops.dataBatchFromFiles([os.path.join(pp, ff) for ff in batch], vidWidth, vidHeight)
+	return np.array([fileops.dataFromFile(packFrames[ff][0], vidWidth, vidHeight, packFrames[ff][1]) if ff in packFrames else fileops.dataFromFile(os.path.join(pp, ff), vidWidth, vidHeight) for ff in batch])
+
+# Trained dictionaries of trained codecs, by index variation (i, regSize, layout, compression)
+dictionaries = {}
+
+# Train a dictionary for every index variation of every trained codec (see compressors.trainDictionary), on the histograms
+# of --dictsamples diffs spread evenly over dirlist. Files of i frames are split in i samples, so every variation is trained
+# on the same number of samples. Dictionaries are also written to the directory of the compressed files, so their size is
+# counted in the results. Codecs no dictionary can be trained for (e.g. with too few diffs) are skipped.
+def trainDictionaries():
+	trained = [compression for compression in codecs if compressors.isTrained(compression)]
+	if len(trained) == 0:
+		return
+
+	picks = sorted(set(np.linspace(0, len(dirlist)-1, min(args.dictsamples, len(dirlist))).astype(int)))
+	sample = [dirlist[k] for k in picks]
+	hists = dict((regSize, []) for regSize in regSizes)
+	for batchStart in range(0, len(sample), batchSize):
+		data = readBatch(sample[batchStart:batchStart+batchSize])
+		for regSize in regSizes:
+			hists[regSize].extend(fileops.regionsFromDataBatch(data, regSize, cols))
+
+	samples = {}
 	for regSize in regSizes:
-		timings = allTimings[regSize]
-		
-		# Calculate histograms from data
-		linearHist = fileops.regionsFromData(data, regSize, cols)
-	
-		# Output and compress a number of files simultaneously
-		for i in histograms.keys():
-			histograms[i][regSize].append(linearHist)
-		
-			# Write the regions in a file for this regionsize and number of histograms
-			cp = os.path.join(pp, "frames_"+str(i), str(regSize))
-			fileops.ensureDir(cp)
+		stack = fileops.histToArray(hists[regSize])
+		for i in frames:
+			for layout in layouts:
+				samples[(i, regSize, layout)] = []
+				for k in range(0, len(stack), i):
+					block = fileops.histLayoutArray(stack[k:k+i], layout, wavelet).tobytes()
+					parts = len(stack[k:k+i])
+					samples[(i, regSize, layout)].extend(block[p*len(block)/parts:(p+1)*len(block)/parts] for p in range(0, parts))
+
+	for compression in trained:
+		try:
+			for (i, regSize, layout), variationSamples in samples.items():
+				dictionaries[(i, regSize, layout, compression)] = compressors.trainDictionary(compression, variationSamples, args.dictsize)
+		except ValueError as e:
+			print "Skipping codec {}: {}".format(compression, e)
+			codecs.remove(compression)
+			del compressions[compression]
+			continue
+		for (i, regSize, layout), variationSamples in samples.items():
+			path = os.path.join(pp, "frames_"+str(i), str(regSize), layout, compression)
+			fileops.ensureDir(path)
+			with open(os.path.join(path, "dictionary"), "wb") as of:
+				of.write(dictionaries[(i, regSize, layout, compression)])
+		print "Trained {} dictionaries for codec {} on {} diffs".format(len(samples), compression, len(sample))
+
+# Choose the wavelet and budget of the wavelet layout on the region histograms of --dictsamples diffs spread evenly over dirlist
+# (see fileops.selectWavelet)
+def chooseWavelet():
+	picks = sorted(set(np.linspace(0, len(dirlist)-1, min(args.dictsamples, len(dirlist))).astype(int)))
+	sample = [dirlist[k] for k in picks]
+	hists = []
+	for batchStart in range(0, len(sample), batchSize):
+		data = readBatch(sample[batchStart:batchStart+batchSize])
+		for regSize in regSizes:
+			hists.append(fileops.regionsFromDataBatch(data, regSize, cols).reshape((-1, cols)))
+	chosen = fileops.selectWavelet(np.concatenate(hists))
+	print "Chose wavelet {} with budget {} on {} diffs".format(chosen[0], chosen[1], len(sample))
+	return chosen
+
+if args.wavelet == "auto" and any(layout in fileops.waveletLayouts for layout in layouts):
+	wavelet = chooseWavelet()
+
+trainDictionaries()
+
+# Index files for all index variations, if wanted
+indexWriters = openIndexWriters() if args.index else {}
+
+# Histogram, lay out and compress the diffs in names, which are dirlist[first:first+len(names)].
+# Tasks are run with submit (submitTask or runTask), timings are recorded in timings (see newTimings),
+# and index blocks are appended to the writers in indexWriters.
+# Groups of frames are counted from the start of dirlist, so a range starting at a multiple of every # frames per file
+# is grouped exactly as it would be when processing all of dirlist at once.
+def processRange(first, names, submit, timings, indexWriters):
+	# Lists for storing several images worth of histograms, to experiment with compression of longer runs of data
+	# The timestamps (frame numbers) of the histograms are kept alongside them, for index files.
+	histograms = {}
+	timestamps = {}
+	for i in frames:
+		histograms[i] = {}
+		timestamps[i] = {}
+		for regSize in regSizes:
+			histograms[i][regSize] = []
+			timestamps[i][regSize] = []
+
+	# Process all files in the range with all region sizes
+	filecount = first
+	for batchStart in range(0, len(names), batchSize):
+		batch = names[batchStart:batchStart+batchSize]
+
+		# Read data from files (once!)
+		data = readBatch(batch)
+
+		# Calculate histograms for the whole batch, for all region sizes
+		if pyramid:
+			# Sum finer grids into coarser ones
+			batchHists = fileops.regionPyramidFromData(data, regSizes, cols)
+		else:
+			batchHists = {}
+			for regSize in regSizes:
+				batchHists[regSize] = fileops.regionsFromDataBatch(data, regSize, cols)
+
+		for b, ff in enumerate(batch):
+			filecount += 1
+
+			# Iterate over different numbers of regions.
+			for regSize in regSizes:
+				regTimings = timings[regSize]
+
+				# Histograms for this file, calculated for the whole batch above
+				linearHist = batchHists[regSize][b]
 		
-			if filecount % i == 0 or ff == dirlist[-1]:
-				if debug:
-					print "Processing {}, i {}, length {}, first {}, linear {}, file {}, regsize {}".format(filecount, i, len(histograms[i][regSize]), len(histograms[i][regSize][0]), len(linearHist), cp, regSize)
-				
-				# Output the histograms to disk with different layouts, and compress them
-				for layout in layouts:
-					path, fileName = fileops.histToFileLayout(cp, ff, histograms[i][regSize], layout, True) # True = overwrite
-					pool.apply_async(fileops.compressFile, (path, fileName), callback=recordTimingsFact(timings[i][layout]["individual"]))
+				# Output and compress a number of files simultaneously
+				for i in histograms.keys():
+					histograms[i][regSize].append(linearHist)
+					timestamps[i][regSize].append(diffTimestamp(ff) if diffTimestamp(ff) >= 0 else filecount)
+			
+					# Write the regions in a file for this regionsize and number of histograms
+					cp = os.path.join(pp, "frames_"+str(i), str(regSize))
+					fileops.ensureDir(cp)
+			
+					if filecount % i == 0 or ff == dirlist[-1]:
+						if debug:
+							print "Processing {}, i {}, length {}, first {}, linear {}, file {}, regsize {}".format(filecount, i, len(histograms[i][regSize]), len(histograms[i][regSize][0]), len(linearHist), cp, regSize)
 					
+						# Output the histograms to disk with different layouts, and compress them. Workers get the histograms
+						# in memory, lay them out, write them and compress them, so nothing is read back from disk.
+						stack = fileops.histToArray(histograms[i][regSize])
+						for layout in layouts:
+							submit(fileops.compressHistograms, (cp, ff, stack, layout, compressions.keys(), variationDictionaries(i, regSize, layout), wavelet), recordTimingsFact(regTimings[i][layout]["individual"]))
+							for compression in compressions.keys():
+								if (i, regSize, layout, compression) in indexWriters:
+									writer = indexWriters[(i, regSize, layout, compression)]
+									submit(histindex.blockSections, (stack,) + writer.encoding(), appendSectionsFact(writer, timestamps[i][regSize]))
+						
+						
+						#pathLinear, linear, pathBinned, binned, pathRegLin, reglin, pathRegBin, regbin = fileops.histToFile(cp, ff, histograms[i][regSize])
 					
-				#pathLinear, linear, pathBinned, binned, pathRegLin, reglin, pathRegBin, regbin = fileops.histToFile(cp, ff, histograms[i][regSize])
-				
-				if debug:
-					print "Written to disk: {}".format(ff)
-	
-				# Compress the histograms using process pool, record timings
-				#recordTimingsFact(timings[i]["linear"]["individual"])(fileops.compressFile(pathLinear, linear))
-				#pool.apply_async(fileops.compressFile, (pathLinear, linear), callback=recordTimingsFact(timings[i]["linear"]["individual"]))
-				#pool.apply_async(fileops.compressFile, (pathBinned, binned), callback=recordTimingsFact(timings[i]["binned"]["individual"]))
-				#pool.apply_async(fileops.compressFile, (pathRegLin, reglin), callback=recordTimingsFact(timings[i]["reg-linear"]["individual"]))
-				#pool.apply_async(fileops.compressFile, (pathRegBin, regbin), callback=recordTimingsFact(timings[i]["reg-binned"]["individual"]))
+						if debug:
+							print "Written to disk: {}".format(ff)
 		
-				histograms[i][regSize] = []
-				
-	print "Processed file {:>4}/{:>4}: {:<3.1f}%".format(filecount, len(dirlist), (100*filecount)/float(len(dirlist)))
+						# Compress the histograms using process pool, record timings
+						#recordTimingsFact(timings[i]["linear"]["individual"])(fileops.compressFile(pathLinear, linear))
+						#pool.apply_async(fileops.compressFile, (pathLinear, linear), callback=recordTimingsFact(timings[i]["linear"]["individual"]))
+						#pool.apply_async(fileops.compressFile, (pathBinned, binned), callback=recordTimingsFact(timings[i]["binned"]["individual"]))
+						#pool.apply_async(fileops.compressFile, (pathRegLin, reglin), callback=recordTimingsFact(timings[i]["reg-linear"]["individual"]))
+						#pool.apply_async(fileops.compressFile, (pathRegBin, regbin), callback=recordTimingsFact(timings[i]["reg-binned"]["individual"]))
+			
+						histograms[i][regSize] = []
+						timestamps[i][regSize] = []
+					
+			print "Processed file {:>4}/{:>4}: {:<3.1f}%".format(filecount, len(dirlist), (100*filecount)/float(len(dirlist)))
+
+# Shard worker: process dirlist[first:first+count] (see processRange), compressing in this worker process and writing
+# index blocks to separate part files. Return the timings and the names of the part files of every index variation.
+def processShard(first, count):
+	shardTimings = newTimings()
+	partWriters = openIndexWriters(".part{}".format(first)) if args.index else {}
+	processRange(first, dirlist[first:first+count], runTask, shardTimings, partWriters)
+	for writer in partWriters.values():
+		writer.close()
+	return shardTimings, dict((key, writer.name) for key, writer in partWriters.items())
+
+# Add the timings of a shard to allTimings
+def mergeTimings(timings):
+	for regSize, regTimings in timings.iteritems():
+		for i, frameTimings in regTimings.iteritems():
+			for layout, layoutTimings in frameTimings.iteritems():
+				individual = allTimings[regSize][i][layout]["individual"]
+				for compression, compressionTimings in layoutTimings["individual"].iteritems():
+					if not compression in individual:
+						individual[compression] = {}
+					for k, v in compressionTimings.iteritems():
+						individual[compression].setdefault(k, []).extend(v)
+
+# Parallelization pool. Created after all functions used by the workers are defined.
+pool = Pool(processes=processes)
+
+if shards > 1:
+	# Split dirlist in contiguous shards holding a multiple of every # frames per file, so no file of frames is split between shards.
+	# Shards are merged in order: timings are added up, and the blocks of the index part files are appended to the index files.
+	step = reduce(lambda a, b: a*b/gcd(a, b), frames)
+	shardSize = max(1, int(math.ceil(len(dirlist) / float(shards*step)))) * step
+	shardResults = [pool.apply_async(processShard, (first, shardSize)) for first in range(0, len(dirlist), shardSize)]
+	for result in shardResults:
+		shardTimings, partNames = result.get()
+		mergeTimings(shardTimings)
+		for key, partName in partNames.items():
+			indexWriters[key].appendIndex(partName)
+			os.remove(partName)
+else:
+	processRange(0, dirlist, submitTask, allTimings, indexWriters)
 
 # Wait for all compressors to finish	
+while len(tasks) > 0:
+	finishTask()
 pool.close()
 pool.join()
+for writer in indexWriters.values():
+	writer.close()
 
 
 #####################################################
@@ -294,7 +585,7 @@ with open(os.path.join(resultPath, "results_{}.csv".format(resultPost)), "w") as
 
 ## Create diagrams and save them	
 plt.rc('legend',**{'fontsize':6})
-colors = ['b', 'r', 'g', 'k']
+colors = ['b', 'r', 'g', 'k', 'm', 'c', 'y']
 for framenum in frames:
 	for regSize in regSizes:
 		resultList = sorted(filterList(results, {"fileframes": framenum, "regions": regSize*regSize}), key=lambda x: x.compression)
@@ -306,7 +597,7 @@ for framenum in frames:
 		# Plot bars for all layouts in one plot ..
 		for idx, layout in enumerate(layouts):
 			ratios = [n.ratio()/n.totalTime() for n in resultList if n.layout==layout]
-			plt.barh(bars-idx*(height)+3*height/2, ratios, height, align='center', color=colors[idx], alpha=0.3, label=layout)
+			plt.barh(bars-idx*(height)+3*height/2, ratios, height, align='center', color=colors[idx % len(colors)], alpha=0.3, label=layout)
 		plt.legend()
 		plt.yticks(bars, sorted(compressions.keys()))
 		plt.xlabel('Ratio per second')
@@ -320,7 +611,7 @@ for framenum in frames:
 		# Plot bars for all layouts in one plot ..
 		for idx, layout in enumerate(layouts):
 			ratios = [n.ratio() for n in resultList if n.layout==layout]
-			plt.barh(bars-idx*(height)+3*height/2, ratios, height, align='center', color=colors[idx], alpha=0.3, label=layout)
+			plt.barh(bars-idx*(height)+3*height/2, ratios, height, align='center', color=colors[idx % len(colors)], alpha=0.3, label=layout)
 		plt.legend()
 		plt.yticks(bars, sorted(compressions.keys()))
 		plt.xlabel('Ratio')
@@ -334,7 +625,7 @@ for framenum in frames:
 		# Plot bars for all layouts in one plot ..
 		for idx, layout in enumerate(layouts):
 			ratios = [n.totaltimecompress for n in resultList if n.layout==layout]
-			plt.barh(bars-idx*(height)+3*height/2, ratios, height, align='center', color=colors[idx], alpha=0.3, label=layout)
+			plt.barh(bars-idx*(height)+3*height/2, ratios, height, align='center', color=colors[idx % len(colors)], alpha=0.3, label=layout)
 		plt.legend()
 		plt.yticks(bars, sorted(compressions.keys()))
 		plt.xlabel('Compression time')
@@ -348,7 +639,7 @@ for framenum in frames:
 		# Plot bars for all layouts in one plot ..
 		for idx, layout in enumerate(layouts):
 			ratios = [n.totaltimedecompress for n in resultList if n.layout==layout]
-			plt.barh(bars-idx*(height)+3*height/2, ratios, height, align='center', color=colors[idx], alpha=0.3, label=layout)
+			plt.barh(bars-idx*(height)+3*height/2, ratios, height, align='center', color=colors[idx % len(colors)], alpha=0.3, label=layout)
 		plt.legend()
 		plt.yticks(bars, sorted(compressions.keys()))
 		plt.xlabel('Decompression time')
@@ -358,8 +649,8 @@ for framenum in frames:
 
 
 for layout in layouts:
-	# Only consider a layout at a time. Only consider zlib-6 compression
-	resultList = sorted(filterList(results, {"layout": layout, "compression": "zlib-6"}), key=lambda x: x.regions)
+	# Only consider a layout at a time. Only consider zlib-6 compression (or the first codec, if zlib-6 isn't used)
+	resultList = sorted(filterList(results, {"layout": layout, "compression": "zlib-6" if "zlib-6" in codecs else codecs[0]}), key=lambda x: x.regions)
 
 	# Create a chart for ratio depending on region sizes.
 	# Each line should be the number of frames data is stored in.
@@ -369,7 +660,7 @@ for layout in layouts:
 	for idx, framenum in enumerate(frames):
 		ys = [n.totalsize/(float(n.regions*n.totalframes)) for n in resultList if n.fileframes==framenum]
 		print "{} fileframes, bytes per region: {}".format(framenum, str(ys))
-		axes.plot(xs, ys, colors[idx]+"o--", label="{} frames/file".format(framenum))
+		axes.plot(xs, ys, colors[idx % len(colors)]+"o--", label="{} frames/file".format(framenum))
 	axes.legend()	
 	axes.set_ylabel("Space in bytes per region on average")
 	axes.set_xlabel("Number of regions")
@@ -423,6 +714,9 @@ for i in range(0, len(regionHistograms)):
 		regionHist = np.diff(cumRegionHist)
 		classify = wavecomp.createCompressions(regionHist, cumRegionHist, False, True, True, "("+str(i)+", "+str(j)+")", 0.95, 10)
 
+# Or choose one wavelet and budget for all regions at once, trying all wavelets in a few batched transforms
+wavelet, budget = wavecomp.selectCompressions(regionHistograms, ["("+str(i)+", "+str(j)+")" for i in range(0, len(regionHistograms)) for j in range(0, len(regionHistograms[0]))], True, True)
+
 
 fig = plt.figure()
 plt.imshow(data)
@@ -2,16 +2,17 @@ import numpy as np
 import math as math
 import subprocess as proc
 import struct as struct
-import snappy as snappy
 import zlib as zlib
-import bz2 as bz2
-import pylzma as pylzma
-import liblzma as xz
-import lz4 as lz4
+import compressors
 import sys
 import os
 import time
 
+try:
+	import pywt as pywt
+except ImportError:
+	pywt = None
+
 debug=False
 colors=256
 
@@ -54,15 +55,47 @@ def dirSize(path):
 # regColumns = number of region columns
 # regRows = number of region rows
 # colors = maximum value for diff-data
-def dataFromFile(name, width, height):
+#
+# If frame is given, name is a diff pack written by DiffPackWriter, and the diff with index frame in it is returned.
+# The diff is memory mapped from the pack, so only the pages holding it are read.
+def dataFromFile(name, width, height, frame=None):
 	if debug:
 		tt = time.clock()
-	data = np.fromfile(name, dtype=np.ubyte).reshape((height, width))
+	if frame is None:
+		data = np.fromfile(name, dtype=np.ubyte).reshape((height, width))
+	else:
+		names, offsets = readDiffPack(name)
+		data = np.memmap(name, dtype=np.ubyte, mode='r', offset=offsets[frame], shape=(height, width))
 	if debug:
 		print "Time spent reading data (new): {}".format(time.clock()-tt)
 
 	return data
 
+# Read a batch of diffs into a single (N, height, width) array, where N = len(names).
+# Diffs are read straight into the batch array, which is only allocated once per batch.
+# Raise an IOError if a diff doesn't hold exactly width*height bytes.
+def dataBatchFromFiles(names, width, height):
+	if debug:
+		tt = time.clock()
+	data = np.empty((len(names), height, width), dtype=np.ubyte)
+	for i in range(0, len(names)):
+		with open(names[i], "rb") as f:
+			size = os.fstat(f.fileno()).st_size
+			if size != width*height or f.readinto(data[i]) != width*height:
+				raise IOError("Diff {} holds {} bytes, expected {}x{}".format(names[i], size, width, height))
+	if debug:
+		print "Time spent reading batch of {}: {}".format(len(names), time.clock()-tt)
+
+	return data
+
+# Return a (count, height, width) view of the diffs with index start to start+count-1 in the diff pack with the given name.
+# Diffs appended to a pack are stored contiguously, so all of them are memory mapped at once.
+def dataBatchFromPack(name, width, height, start, count):
+	names, offsets = readDiffPack(name)
+	if offsets[start+count-1] - offsets[start] != (count-1)*width*height:
+		return np.array([dataFromFile(name, width, height, frame) for frame in range(start, start+count)])
+	return np.memmap(name, dtype=np.ubyte, mode='r', offset=offsets[start], shape=(count, height, width))
+
 
 def queryOnData(data, regCount, queryArea, thresholdValue, thresholdFrac):
 	height = len(data)
@@ -106,38 +139,157 @@ def queryOnData(data, regCount, queryArea, thresholdValue, thresholdFrac):
 		print "Above: {}. Total: {}.".format(pixelsAboveValue, totalPixels)
 	return (pixelsAboveValue / float(totalPixels)) > thresholdFrac
 	
-def queryOnCompressedHistogram(filepath, regCount, queryArea, thresholdValue, thresholdFrac):
+# Answer a query on a compressed (zlib) histogram file holding linearly stored (frames, regCount, regCount, colors) histograms
+# of diffs with the given width and height. The last file of a recording may hold fewer frames than the others.
+# Return a bool array with the answer for each frame in the file.
+def queryOnCompressedHistogram(filepath, regCount, queryArea, thresholdValue, thresholdFrac, width, height):
 	dec_bytes = open(filepath, "rb").read()
 	bytes = zlib.decompress(dec_bytes)
 	
-	data = np.frombuffer(bytes, dtype=np.int16).reshape((regCount, regCount, colors))
-	
-	# Assume queryArea is dict with keys = X-region, and values a list of Y-regions
-	# Find the no. changed pixels above threshold for each query area, then sum those to answer query
-	pixelsAboveValue = 0
-	totalPixels = 0
-	for i in sorted(queryArea.keys()):
-		for j in queryArea[i]:
-			pixelsBelowValue = data[i][j][thresholdValue-1]
-			if thresholdValue == 0:
-				pixelsBelowValue = 0
-			#pixelsBelowValue = histValFromFileLinear(bytes, regCount, i, j, thresholdValue-1) # assume thresholdValue > 0
-			
-			regPixels = data[i][j][colors-1]
-			#regPixels = histValFromFileLinear(bytes, regCount, i, j, colors-1) # get # pixels in histogram
-			regPixelsAboveValue = regPixels - pixelsBelowValue
-			pixelsAboveValue += regPixelsAboveValue
-			totalPixels += regPixels
-			
-			if debug:
-				print "I: {} J: {} K: {}. Above: {}. Total: {}.".format(i, j, thresholdValue, regPixelsAboveValue, regPixels)
-	
+	# Values are stored as shorts, or ints if the largest region holds too many pixels (see histToArray)
+	dtype = histDtypeFromSize(len(bytes), width, height, regCount)
+	data = np.frombuffer(bytes, dtype=dtype).reshape((-1, regCount, regCount, colors))
+	return evaluateQuery(data, queryMask(regCount, queryArea), [(thresholdValue, thresholdFrac)])[0]
+
+# Answer a query on the cumulative region histograms of a frame, given as a (regCount, regCount, colors) matrix.
+def queryOnHistogram(data, queryArea, thresholdValue, thresholdFrac):
+	return evaluateQuery(data[np.newaxis], queryMask(len(data), queryArea), [(thresholdValue, thresholdFrac)])[0, 0]
+
+# Return a (regCount, regCount) bool mask, True for the regions in queryArea.
+# Assume queryArea is dict with keys = X-region, and values a list of Y-regions
+def queryMask(regCount, queryArea):
+	mask = np.zeros((regCount, regCount), dtype=bool)
+	for i in queryArea.keys():
+		mask[i, queryArea[i]] = True
+	return mask
+
+# Answer a list of rules [(thresholdValue, thresholdFrac), ...] on a block of cumulative region histograms with
+# shape (frames, regCount, regCount, colors) or (frames, regCount*regCount, colors), for the regions True in mask (see queryMask).
+# Return a (rules, frames) bool array, True where more than thresholdFrac of the pixels in the mask changed more than thresholdValue.
+def evaluateQuery(data, mask, rules):
+	data = data.reshape((len(data), -1, data.shape[-1]))
+	return evaluateQueryOnRegions(data[:, mask.ravel()], rules)
+
+# As evaluateQueryOnRegions, on a (frames, regions, colors) block of values transformed with the given layout (see transformedFromBytes)
+# holding only the queried regions. The inverse transforms are fused into the query: the frame transforms are undone on the
+# queried regions only, and the counts of the regions are summed before the bin-wise sum turns them into one cumulative histogram.
+def evaluateQueryOnTransformed(values, layout, rules, lookup=None):
+	counts = undoFrameTransforms(values, layout).sum(axis=1, dtype=np.int64)
+	return evaluateQueryOnRegions(counts.cumsum(axis=1)[:, np.newaxis], rules, lookup)
+
+# As evaluateQuery, on a (frames, regions, colors) block holding only the histograms of the queried regions.
+# lookup gives the bins to count the pixels below every threshold value with (see thresholdBins), by default the exact ones.
+def evaluateQueryOnRegions(data, rules, lookup=None):
+	if lookup is None:
+		lookup = thresholdBins([rule[0] for rule in rules])
+	fracs = np.array([rule[1] for rule in rules], dtype=np.float64)
+
+	# Histograms are cumulative: last bin is the # pixels in the region, bin value-1 the # pixels below value
+	totalPixels = data[:, :, -1].sum(axis=1, dtype=np.int64)
+	pixelsBelowValue = lookupBins(lambda b: data[:, :, b].sum(axis=1, dtype=np.int64), lookup)
+	pixelsAboveValue = totalPixels[:, np.newaxis] - pixelsBelowValue
+	return answerQuery(pixelsAboveValue, totalPixels, fracs)
+
+# Return the bins of cumulative histograms to count the # pixels changed less than every threshold value in values with, as
+# (low, high, weight) arrays: the count is bin low plus weight times the difference to bin high, where bin -1 holds 0 pixels.
+# Without binEdges, bin value-1 of full histograms is used. For histograms quantized to binEdges (see quantizeHistograms),
+# values on an edge (or 0, or colors and above) are exact too. A value between two edges lies between two stored bins, and
+# the true count lies between their counts. between chooses the count used:
+#	"interpolate"	linear interpolation between the two bins (as the bucket approximation in wavecomp.createCompressions)
+#	"sure"			the upper bin, the least # pixels that can have changed at least value, so only frames that surely match are found
+#	"possible"		the lower bin, the most # pixels that can have changed at least value, so all frames that may match are found
+def thresholdBins(values, binEdges=None, between="interpolate", colors=colors):
+	values = np.asarray(values, dtype=np.intp)
+	if binEdges is None:
+		return values - 1, values - 1, np.zeros(len(values))
+
+	# Stored bin j-1 counts the pixels below points[j], so points[0] = 0 has no bin and points[-1] = colors is the total
+	points = np.concatenate(([0], binEdges, [colors]))
+	values = np.minimum(values, colors)
+	j = np.searchsorted(points, values, side="right") - 1
+	exact = points[j] == values
+	low = j - 1
+	high = np.where(exact, low, j)
+	nextPoint = points[np.minimum(j + 1, len(points) - 1)]
+	if between == "interpolate":
+		weight = np.where(exact, 0.0, (values - points[j]) / np.maximum(nextPoint - points[j], 1).astype(np.float64))
+	elif between == "sure":
+		weight = np.where(exact, 0.0, 1.0)
+	elif between == "possible":
+		weight = np.zeros(len(values))
+	else:
+		raise ValueError("Unknown between {}, use interpolate, sure or possible".format(between))
+	return low, high, weight
+
+# Return the (frames, rules) counts for the bins in lookup (see thresholdBins), where count(bins) returns the (frames, len(bins))
+# counts of the given (non-negative) bins
+def lookupBins(count, lookup):
+	low, high, weight = lookup
+	lowCounts = np.where(low >= 0, count(np.maximum(low, 0)), 0)
+	if not weight.any():
+		return lowCounts
+	highCounts = np.where(high >= 0, count(np.maximum(high, 0)), 0)
+	return lowCounts + weight*(highCounts - lowCounts)
+
+# Return the (frames, regions, len(binEdges)+1) histograms quantized to binEdges from the (frames, regions, colors) cumulative
+# histograms stack: the # pixels changed less than every edge (bin edge-1), followed by the # pixels in the region.
+# The result is cumulative too, so it can be stored with any layout.
+def quantizeHistograms(stack, binEdges):
+	return np.concatenate((stack[:, :, np.asarray(binEdges, dtype=np.intp) - 1], stack[:, :, -1:]), axis=2)
+
+# Return a (rules, frames) bool array from the (frames, rules) # pixels above the threshold values, the (frames) # pixels
+# in the query area and the threshold fractions of the rules.
+def answerQuery(pixelsAboveValue, totalPixels, fracs):
 	# True if more then pct pixels changed more than threshold
-	if debug:
-		print "Above: {}. Total: {}.".format(pixelsAboveValue, totalPixels)
-	return (pixelsAboveValue / float(totalPixels)) > thresholdFrac
-			
-	
+	with np.errstate(divide='ignore', invalid='ignore'):
+		return (pixelsAboveValue / totalPixels[:, np.newaxis].astype(np.float64) > fracs).T
+
+# Return the bounds (i0, i1, j0, j1) (both included) of the rectangle of regions in queryArea, or None if it isn't a rectangle.
+def queryRectangle(queryArea):
+	rows = sorted(i for i in queryArea.keys() if len(queryArea[i]) > 0)
+	if len(rows) == 0 or rows != range(rows[0], rows[-1]+1):
+		return None
+	columns = sorted(set(queryArea[rows[0]]))
+	if columns != range(columns[0], columns[-1]+1):
+		return None
+	for i in rows:
+		if sorted(set(queryArea[i])) != columns:
+			return None
+	return rows[0], rows[-1], columns[0], columns[-1]
+
+# Return summed-area tables of the # pixels changed more than each of the given levels, from a (frames, regCount*regCount, colors)
+# array of cumulative region histograms. The result has shape (frames, len(levels)+1, regCount+1, regCount+1), the last table counting all pixels.
+# Entry [f, l, i, j] is the sum over the regions in rows before i and columns before j, so a rectangle is summed with four lookups (see rectangleSums).
+def summedAreaTables(stack, levels, regCount):
+	levels = np.asarray(levels, dtype=np.intp)
+	totalPixels = stack[:, :, -1].astype(np.int64)
+	pixelsBelowValue = stack[:, :, np.maximum(levels-1, 0)].astype(np.int64)
+	pixelsBelowValue[:, :, levels == 0] = 0
+	counts = np.concatenate((totalPixels[:, :, np.newaxis] - pixelsBelowValue, totalPixels[:, :, np.newaxis]), axis=2)
+	counts = counts.transpose((0, 2, 1)).reshape((len(stack), len(levels)+1, regCount, regCount))
+
+	tables = np.zeros((len(stack), len(levels)+1, regCount+1, regCount+1), dtype=np.int64)
+	tables[:, :, 1:, 1:] = counts.cumsum(axis=2).cumsum(axis=3)
+	return tables
+
+# Return a summary of a (frames, regions, colors) array of cumulative region histograms: the maximum over all frames of the
+# # pixels changed at least each of the given levels, as a (regions, levels) array, and the largest change in every region.
+def histSummary(stack, levels):
+	levels = np.asarray(levels, dtype=np.intp)
+	totalPixels = stack[:, :, -1].astype(np.int64)
+	pixelsBelowValue = stack[:, :, np.maximum(levels-1, 0)].astype(np.int64)
+	pixelsBelowValue[:, :, levels == 0] = 0
+	maxAbove = (totalPixels[:, :, np.newaxis] - pixelsBelowValue).max(axis=0)
+
+	# The largest value in a region is the number of bins before the cumulative histogram reaches the region size
+	maxDiff = (stack < stack[:, :, -1:]).sum(axis=2).max(axis=0)
+	return maxAbove, maxDiff
+
+# Return the sums over the rectangle (i0, i1, j0, j1) (both included) of summed-area tables (see summedAreaTables), with shape (frames, levels+1)
+def rectangleSums(tables, rect):
+	i0, i1, j0, j1 = rect
+	return tables[..., i1+1, j1+1].astype(np.int64) - tables[..., i0, j1+1] - tables[..., i1+1, j0] + tables[..., i0, j0]
+
 
 # Extract a single value from a byte sequence from a linearly stored file
 """def histValFromFileLinear(bytes, regCount, regionCol, regionRow, thresholdValue):
@@ -195,9 +347,111 @@ def regionsFromData(data, regCount, colors):
 	if debug: 
 		print "Time for cumsums: {}".format(time.clock() - tt)
 
-		
+
 	return regionHistograms
-	
+
+
+# Region-ID maps, cached per (width, height, regCount, colors) geometry.
+regionMaps = {}
+
+# Return a 2D matrix with the same shape as a diff frame, where index i, j holds the offset of the region
+# that pixel i, j belongs to, multiplied by colors (i.e. region*colors). Adding a diff value to this offset
+# gives a unique key for every (region, value) pair, so all region histograms can be counted by a single bincount.
+# Regions are placed as in regionsFromData: remaining pixels are put in the last row/column of regions.
+def regionIdMap(width, height, regCount, colors):
+	key = (width, height, regCount, colors)
+	if key not in regionMaps:
+		regWidth = width / regCount # Will round down to nearest int
+		regHeight = height / regCount
+
+		# Pixels past the last full region are clamped into the last row/column of regions
+		rowIds = np.minimum(np.arange(height) // regHeight, regCount-1)
+		colIds = np.minimum(np.arange(width) // regWidth, regCount-1)
+		regionMaps[key] = ((rowIds[:, np.newaxis]*regCount + colIds[np.newaxis, :]) * colors).astype(np.intp)
+
+	return regionMaps[key]
+
+# Vectorized version of regionsFromData giving the same output.
+# All region histograms are computed in one pass using the region-ID map for the geometry of data,
+# followed by a single cumsum along the color axis.
+# Assumes all diff values are in the range 0 to colors-1.
+def regionsFromDataFast(data, regCount, colors):
+	height = len(data)
+	width = len(data[0])
+
+	if debug:
+		tt = time.clock()
+	keys = regionIdMap(width, height, regCount, colors) + data
+	regionHistograms = np.bincount(keys.ravel(), minlength=regCount*regCount*colors).reshape((regCount*regCount, colors))
+	if debug:
+		print "Time to read data: {}".format(time.clock() - tt)
+
+	if debug:
+		tt = time.clock()
+	regionHistograms = np.cumsum(regionHistograms, axis=1)
+	if debug:
+		print "Time for cumsums: {}".format(time.clock() - tt)
+
+	return regionHistograms
+
+# Batched version of regionsFromDataFast. data is a (N, height, width) array of N diffs.
+# All region histograms of all diffs are computed with a single bincount, by giving every diff its own range of keys.
+# Output:	(N, regCount*regCount, colors) array. Index n = histograms of diff n, as returned by regionsFromDataFast.
+def regionsFromDataBatch(data, regCount, colors):
+	count, height, width = data.shape
+
+	if debug:
+		tt = time.clock()
+	frameOffsets = (np.arange(count, dtype=np.intp) * (regCount*regCount*colors))[:, np.newaxis, np.newaxis]
+	keys = regionIdMap(width, height, regCount, colors) + frameOffsets + data
+	regionHistograms = np.bincount(keys.ravel(), minlength=count*regCount*regCount*colors).reshape((count, regCount*regCount, colors))
+	if debug:
+		print "Time to read data (batch of {}): {}".format(count, time.clock() - tt)
+
+	return np.cumsum(regionHistograms, axis=2)
+
+# True if every region in a coarseCount grid is exactly made up of (fineCount/coarseCount)^2 regions of a fineCount grid,
+# for an image with the given size in one direction. Remaining pixels must end up in the last region of both grids.
+def regionsNest(size, fineCount, coarseCount):
+	if fineCount % coarseCount != 0:
+		return False
+	return size / coarseCount == (fineCount / coarseCount) * (size / fineCount)
+
+# Calculate the region histograms for all region counts in regSizes from a single diff frame.
+# Only the finest grid is histogrammed directly. Coarser grids are built by summing the histograms of their
+# child regions in an already computed finer grid, when the grids nest (see regionsNest).
+# Region counts that don't nest with any finer grid fall back to a direct pass with regionsFromDataFast.
+#
+# data may also be a (N, height, width) batch of diffs, in which case histograms are computed with regionsFromDataBatch.
+#
+# Output: 	dictionary with region counts as keys, and histograms as returned by regionsFromDataFast (or regionsFromDataBatch) as values.
+def regionPyramidFromData(data, regSizes, colors):
+	height, width = data.shape[-2:]
+	lead = data.shape[:-2]
+
+	pyramid = {}
+	for regCount in sorted(set(regSizes), reverse=True):
+		# Use the coarsest already computed grid that this grid nests in (fewest histograms to sum)
+		fineCount = None
+		for computed in sorted(pyramid.keys()):
+			if regionsNest(width, computed, regCount) and regionsNest(height, computed, regCount):
+				fineCount = computed
+				break
+
+		if fineCount is None and len(lead) == 0:
+			pyramid[regCount] = regionsFromDataFast(data, regCount, colors)
+		elif fineCount is None:
+			pyramid[regCount] = regionsFromDataBatch(data, regCount, colors)
+		else:
+			k = fineCount / regCount
+			fine = pyramid[fineCount].reshape(lead + (regCount, k, regCount, k, colors))
+			pyramid[regCount] = fine.sum(axis=(-4, -2)).reshape(lead + (regCount*regCount, colors))
+
+		if debug:
+			print "Pyramid level {} computed from {}".format(regCount, fineCount)
+
+	return pyramid
+
 
 # Take a list of region histograms and write all of them to a single file with the given basename.
 # The function assumes a few things about the list of histograms:
@@ -213,128 +467,586 @@ def histToFileLayout(path, name, hist, layout, overwrite=False):
 	fileName = name+".hist."+layout
 	
 	if not isFile(pathLayout, fileName) or isEmpty(pathLayout, fileName) or overwrite:	
-		bufferSize=len(hist)*len(hist[0])*len(hist[0][0])
-		#intType = 'I' if globalBiggest > 64000 else 'H'
-		#intType = 'B' if globalBiggest < 256 else 'H'
-		intType = 'H' # Assume all numbers fit in a short (breaks if full hd and 4x4 regions)
-		intSize = struct.calcsize(intType)
-		bf = np.newbuffer(bufferSize*intSize)
+		# Values are stored as shorts, unless the largest value doesn't fit (e.g. full hd and 4x4 regions)
+		stack = histToArray(hist)
 		
 		with open(os.path.join(pathLayout, fileName), "wb") as of:
 			if layout == "linear":
-				histToFileLinear(of, hist, intType, bf)
+				histToFileLinear(of, stack)
 			elif layout == "binned":
-				histToFileBinned(of, hist, intType, bf)
+				histToFileBinned(of, stack)
 			elif layout == "reg-linear":
-				histToFileRegionLinear(of, hist, intType, bf)
+				histToFileRegionLinear(of, stack)
 			elif layout == "reg-binned":
-				histToFileRegionBinned(of, hist, intType, bf)
+				histToFileRegionBinned(of, stack)
+			elif layout in transformLayouts or layout in truncatedLayouts or layout in waveletLayouts:
+				histLayoutArray(stack, layout).tofile(of)
 				
 	return pathLayout, fileName
-				
+
+# Axis order of the (frames, regions, colors) histogram array for each layout, outermost axis first.
+layoutAxes = {
+	"linear": (0, 1, 2),
+	"binned": (2, 0, 1),
+	"reg-linear": (1, 0, 2),
+	"reg-binned": (1, 2, 0),
+	"bin-delta": (0, 1, 2),
+	"frame-delta": (0, 1, 2),
+	"frame-xor": (0, 1, 2),
+	"varint": (0, 1, 2),
+	"frame-varint": (0, 1, 2),
+	"truncated": (0, 1, 2),
+	"truncated-delta": (0, 1, 2),
+	"wavelet": (0, 1, 2)
+}
+
+# Layouts storing the histograms in the linear order, after reversible transforms that make them compress better.
+# Transforms are applied in the listed order:
+#	bins	bin-wise first differences, turning cumulative histograms back into plain counts
+#	frames	frame-to-frame differences per region and bin, zigzag mapped so small changes of either sign are small values.
+#			The first frame of a file is kept. Differences wrap around in the integer type, so they can always be undone.
+#	xor		frame-to-frame XOR per region and bin. The first frame of a file is kept.
+#	varint	values written as LEB128 varints (7 bits per byte, high bit set on all but the last byte), so small values take one byte
+transformLayouts = {
+	"bin-delta": ["bins"],
+	"frame-delta": ["bins", "frames"],
+	"frame-xor": ["bins", "xor"],
+	"varint": ["bins", "varint"],
+	"frame-varint": ["bins", "frames", "varint"]
+}
+
+# Layouts storing every cumulative histogram only up to the first bin where it reaches the # pixels in the region (saturates),
+# as the remaining bins just repeat it. In quiet video most pixels change little, so only a few bins are kept per region.
+# Stored as the number of frames ("<u4"), the number of values kept for every frame and region ("<u2", in the linear order),
+# followed by the kept values of every frame and region. "truncated-delta" keeps bin counts (see transformLayouts) in place
+# of cumulative values, which compress better.
+truncatedLayouts = ["truncated", "truncated-delta"]
+
+# Lossy layouts storing every cumulative histogram as a few coefficients of its wavelet decomposition (see waveletArray).
+# The wavelet and the number of coefficients kept per histogram (the budget) are given as a (name, budget) pair,
+# by default defaultWavelet. Needs the pywt module.
+waveletLayouts = ["wavelet"]
+defaultWavelet = ("haar", 16)
+
+# The wavelets (default: all discrete wavelets of pywt, by family) and budgets selectWavelet chooses from, and the largest mean quality
+# (see histQuality, relative to the # pixels in the regions) it accepts
+selectionWavelets = None
+selectionBudgets = [4, 8, 16, 24, 32, 40]
+maxQuality = 0.01
+
+# Largest number of histograms selectWavelet tries the wavelets on. More histograms are sampled evenly.
+# All wavelets are first screened on screenHists histograms, and only the screenWavelets best are tried on all.
+selectionHists = 4096
+screenHists = 256
+screenWavelets = 8
+
+# Threshold values the quality of lossy cumulative histograms is measured at (see histQuality)
+qualityValues = [5, 10, 30, 100]
+
+# Return the number of pixels in the largest region (the last one, holding the remaining pixels) of an image
+# with the given size. This is the largest value a cumulative region histogram of the image can hold.
+def maxRegionPixels(width, height, regCount):
+	return (width / regCount + width % regCount) * (height / regCount + height % regCount)
+
+# Return a list of frame histograms (see histToFileLayout) stored in bytes with the given layout, as a (frames, regions, colors)
+# array. This is the inverse of histToBytesLayout, for histograms stored with the given dtype.
+def histFromBytesLayout(bytes, layout, regions, colors, dtype):
+	if layout in truncatedLayouts:
+		return histFromTruncated(*truncatedFromBytes(bytes, layout, regions, dtype), colors=colors)
+	if layout in transformLayouts:
+		return histFromTransformed(transformedFromBytes(bytes, layout, regions, colors, dtype), layout)
+	if layout in waveletLayouts:
+		return waveletFromBytes(bytes, regions, colors, dtype)[0]
+	frames = len(bytes) / (regions*colors*np.dtype(dtype).itemsize)
+	shape = np.array([frames, regions, colors])[list(layoutAxes[layout])]
+	data = np.frombuffer(bytes, dtype=dtype).reshape(shape)
+	return data.transpose(np.argsort(layoutAxes[layout]))
+
+# Return the smallest unsigned integer type that can store values up to biggest.
+def histDtype(biggest):
+	if biggest <= np.iinfo(np.uint16).max:
+		return np.uint16
+	return np.uint32
+
+# Return the integer type of a buffer of nbytes holding (frames, regCount*regCount, colors) histograms of diffs with the given
+# width and height (as written by histToFileLayout). The type follows from the largest region (see histToArray).
+# Raise ValueError if the buffer doesn't hold a whole number of frames of that type.
+def histDtypeFromSize(nbytes, width, height, regCount, colors=colors):
+	dtype = histDtype(maxRegionPixels(width, height, regCount))
+	frameBytes = regCount*regCount*colors*np.dtype(dtype).itemsize
+	if nbytes % frameBytes != 0:
+		raise ValueError("{} bytes is not a whole number of {} histogram frames of {} regions".format(nbytes, np.dtype(dtype).name, regCount*regCount))
+	return dtype
+
+# Stack a list of frame histograms (see histToFileLayout) into one (frames, regions, colors) array.
+# The array uses uint16 values, switching to uint32 if any value is too big to fit in a short.
+def histToArray(hist):
+	stack = np.asarray(hist)
+	dtype = histDtype(stack.max())
+	if debug and dtype != np.uint16:
+		print "Histogram values up to {} do not fit in a short, using {}".format(stack.max(), np.dtype(dtype).name)
+	return stack.astype(dtype)
+
+# Return a contiguous copy of the (frames, regions, colors) array stack with axes ordered as in the given layout.
+# For transform layouts the values are transformed, and with varints the result is a uint8 array of the encoded bytes.
+# wavelet is the (name, budget) of wavelet layouts (default: defaultWavelet).
+def histLayoutArray(stack, layout, wavelet=None):
+	if layout in truncatedLayouts:
+		return truncateArray(stack, layout)
+	if layout in waveletLayouts:
+		return waveletArray(stack, wavelet)
+	if layout in transformLayouts:
+		return transformArray(stack, transformLayouts[layout])
+	return np.ascontiguousarray(stack.transpose(layoutAxes[layout]))
+
+# Apply the list of transforms (see transformLayouts) to a (frames, regions, colors) array of cumulative histograms.
+def transformArray(stack, transforms):
+	stack = np.asarray(stack)
+	values = stack.copy()
+	for transform in transforms:
+		if transform == "bins":
+			values[:, :, 1:] -= stack[:, :, :-1]
+		elif transform == "frames":
+			values[1:] = zigzag(values[1:] - values[:-1])
+		elif transform == "xor":
+			values[1:] = values[1:] ^ values[:-1]
+		elif transform == "varint":
+			values = varintEncode(values.ravel())
+	return values
+
+# Undo the frame transforms (frames, xor) of the given layout on a (frames, regions, colors) array of transformed values.
+# Regions are independent, so this can be done on the queried regions only. The result holds the counts of every bin.
+def undoFrameTransforms(values, layout):
+	transforms = transformLayouts[layout]
+	if "frames" in transforms:
+		values = np.concatenate((values[:1], unzigzag(values[1:]))).cumsum(axis=0, dtype=values.dtype)
+	elif "xor" in transforms:
+		values = np.bitwise_xor.accumulate(values, axis=0)
+	return values
+
+# Return the (frames, regions, colors) array of values stored in bytes with a transform layout, before undoing the transforms
+# other than varint. dtype is the integer type the values were transformed in.
+def transformedFromBytes(bytes, layout, regions, colors, dtype):
+	if "varint" in transformLayouts[layout]:
+		values = varintDecode(np.frombuffer(bytes, dtype=np.uint8)).astype(dtype)
+	else:
+		values = np.frombuffer(bytes, dtype=dtype)
+	return values.reshape((-1, regions, colors))
+
+# Return the cumulative histograms from a (frames, regions, colors) array of values transformed with the given layout
+# (see transformedFromBytes). This is the inverse of histLayoutArray for transform layouts.
+def histFromTransformed(values, layout):
+	counts = undoFrameTransforms(values, layout)
+	return counts.cumsum(axis=2, dtype=counts.dtype)
+
+# Return a uint8 array with the bytes of the (frames, regions, colors) array of cumulative histograms stack stored with
+# a truncated layout (see truncatedLayouts)
+def truncateArray(stack, layout):
+	stack = np.asarray(stack)
+	# Histograms are cumulative, so the values below the last one come first
+	lengths = (stack < stack[:, :, -1:]).sum(axis=2) + 1
+	kept = np.arange(stack.shape[2]) < lengths[:, :, np.newaxis]
+	values = stack
+	if layout == "truncated-delta":
+		values = transformArray(stack, ["bins"])
+	header = np.array([len(stack)], dtype="<u4")
+	return np.concatenate((header.view(np.uint8), lengths.astype("<u2").ravel().view(np.uint8), values[kept].view(np.uint8)))
+
+# Return the histograms stored in bytes with a truncated layout as (lengths, offsets, values): the number of values kept and
+# the offset of the first one in values for every frame and region, as (frames, regions) arrays, and the kept cumulative values.
+# dtype is the integer type of the values.
+def truncatedFromBytes(bytes, layout, regions, dtype):
+	frames = np.frombuffer(bytes, dtype="<u4", count=1)[0]
+	lengths = np.frombuffer(bytes, dtype="<u2", count=frames*regions, offset=4).astype(np.intp)
+	values = np.frombuffer(bytes, dtype=dtype, offset=4 + 2*frames*regions)
+	offsets = np.cumsum(lengths) - lengths
+	if layout == "truncated-delta" and len(values) > 0:
+		# Cumulative sums restarting at the first value of every histogram
+		sums = values.cumsum(dtype=np.int64)
+		values = (sums - np.repeat(sums[offsets] - values[offsets], lengths)).astype(dtype)
+	return lengths.reshape((frames, regions)), offsets.reshape((frames, regions)), values
+
+# Return the (frames, regions, colors) cumulative histograms from their truncated form (see truncatedFromBytes)
+def histFromTruncated(lengths, offsets, values, colors):
+	return values[offsets[:, :, np.newaxis] + np.minimum(np.arange(colors), lengths[:, :, np.newaxis] - 1)]
+
+# As evaluateQueryOnRegions, on the truncated histograms (see truncatedFromBytes) of the queried regions, given by their
+# (frames, regions) lengths and offsets. Every threshold value is a single lookup per frame and region, at the bin
+# below it or at the last value kept if the histogram has already saturated there. lookup is as in evaluateQueryOnRegions.
+def evaluateQueryOnTruncated(lengths, offsets, values, rules, lookup=None):
+	if lookup is None:
+		lookup = thresholdBins([rule[0] for rule in rules])
+	totalPixels = values[offsets + lengths - 1].sum(axis=1, dtype=np.int64)
+	def count(bins):
+		return values[offsets[:, :, np.newaxis] + np.minimum(bins, lengths[:, :, np.newaxis] - 1)].sum(axis=1, dtype=np.int64)
+	pixelsAboveValue = totalPixels[:, np.newaxis] - lookupBins(count, lookup)
+	return answerQuery(pixelsAboveValue, totalPixels, np.array([rule[1] for rule in rules], dtype=np.float64))
+
+# Return the lengths of the coefficient arrays of the full decomposition (pywt.wavedec) of a histogram of colors bins
+# with the named wavelet. Raise ImportError without pywt, and ValueError for unknown wavelets.
+def waveletLengths(name, colors):
+	if pywt is None:
+		raise ImportError("Wavelet layouts need the pywt module")
+	if name not in pywt.wavelist(kind="discrete"):
+		raise ValueError("Unknown discrete wavelet {}".format(name))
+	return [len(c) for c in pywt.wavedec(np.zeros(colors), name)]
+
+# Return a uint8 array with the bytes of the (frames, regions, colors) array of cumulative histograms stack stored with
+# the wavelet layout, keeping at most the budget largest coefficients of every histogram decomposed with the given
+# (name, budget) wavelet (default: defaultWavelet). Kept coefficients are rounded to integers, which compress far better
+# than floats, and those rounded to 0 are dropped, so quiet regions keep only a few.
+# Stored as the number of frames ("<u4"), the budget and the number of coefficients per histogram ("<u2"), the length of
+# the wavelet name ("u1") and the name, followed by (all in the linear order):
+#	the # pixels in every region, as the last bin of the histogram (in the dtype of stack)
+#	the error bound of every histogram: the largest difference from the reconstructed histogram, rounded up (in the dtype of stack)
+#	the number of coefficients kept for every histogram ("<u2")
+#	the positions of the kept coefficients of every histogram, in increasing order ("u1", or "<u2" for more than 256 coefficients)
+#	the kept coefficients ("<i4")
+def waveletArray(stack, wavelet=None):
+	name, budget = wavelet if wavelet is not None else defaultWavelet
+	stack = np.asarray(stack)
+	frames, regions, colors = stack.shape
+	lengths = waveletLengths(name, colors)
+	hists = stack.reshape((-1, colors))
+
+	# Decompose all histograms at once, and keep the largest coefficients of every histogram
+	coeffs = np.concatenate(pywt.wavedec(hists.astype(np.float64), name, axis=1), axis=1)
+	budget = min(budget, coeffs.shape[1])
+	positions = np.sort(np.argsort(-np.abs(coeffs), axis=1)[:, :budget], axis=1)
+	kept = np.rint(coeffs[np.arange(len(coeffs))[:, np.newaxis], positions])
+	nonzero = kept != 0
+	counts = nonzero.sum(axis=1)
+	positions = positions[nonzero]
+	kept = kept[nonzero].astype("<i4")
+
+	# The bound is computed from the stored coefficients, as they are reconstructed when reading.
+	# A small margin covers rounding differences between machines.
+	totals = np.ascontiguousarray(hists[:, -1])
+	errors = np.abs(waveletReconstruct(counts, positions, kept, name, lengths, colors) - hists).max(axis=1)
+	errors = np.minimum(np.ceil(errors + 1e-6), totals).astype(stack.dtype)
+
+	header = np.concatenate((np.array([frames], dtype="<u4").view(np.uint8), np.array([budget, sum(lengths)], dtype="<u2").view(np.uint8), np.array([len(name)], dtype=np.uint8), np.frombuffer(name, dtype=np.uint8)))
+	positionDtype = np.uint8 if sum(lengths) <= 256 else np.dtype("<u2")
+	return np.concatenate((header, totals.view(np.uint8), errors.view(np.uint8), counts.astype("<u2").view(np.uint8), positions.astype(positionDtype).view(np.uint8), kept.view(np.uint8)))
+
+# Return the (histograms, colors) float reconstruction of histograms from the number of coefficients kept for every histogram
+# (counts), and the positions and values of all kept coefficients, decomposed with the named wavelet into coefficient arrays
+# of the given lengths (see waveletLengths)
+def waveletReconstruct(counts, positions, kept, name, lengths, colors):
+	coeffs = np.zeros((len(counts), sum(lengths)))
+	coeffs[np.repeat(np.arange(len(counts)), counts), positions] = kept
+	parts = np.split(coeffs, np.cumsum(lengths)[:-1], axis=1)
+	return pywt.waverec(parts, name, axis=1)[:, :colors]
+
+# Return the histograms stored in bytes with the wavelet layout as the (frames, regions, colors) reconstructed cumulative
+# histograms and the (frames, regions) error bounds. Reconstructed histograms are rounded, kept between 0 and the # pixels
+# in the region and made increasing, and end at the # pixels, so every value differs at most the error bound from the stored one.
+# dtype is the integer type of the histograms.
+def waveletFromBytes(bytes, regions, colors, dtype):
+	frames = int(np.frombuffer(bytes, dtype="<u4", count=1)[0])
+	budget, count = [int(v) for v in np.frombuffer(bytes, dtype="<u2", count=2, offset=4)]
+	nameLength = int(np.frombuffer(bytes, dtype=np.uint8, count=1, offset=8)[0])
+	name = bytes[9:9+nameLength]
+	offset = 9 + nameLength
+
+	histCount = frames*regions
+	itemsize = np.dtype(dtype).itemsize
+	totals = np.frombuffer(bytes, dtype=dtype, count=histCount, offset=offset).astype(np.int64)
+	errors = np.frombuffer(bytes, dtype=dtype, count=histCount, offset=offset + histCount*itemsize)
+	offset += 2*histCount*itemsize
+	counts = np.frombuffer(bytes, dtype="<u2", count=histCount, offset=offset).astype(np.intp)
+	offset += 2*histCount
+	kept = counts.sum()
+	positionDtype = np.uint8 if count <= 256 else np.dtype("<u2")
+	positions = np.frombuffer(bytes, dtype=positionDtype, count=kept, offset=offset).astype(np.intp)
+	values = np.frombuffer(bytes, dtype="<i4", count=kept, offset=offset + kept*np.dtype(positionDtype).itemsize)
+
+	reconstructed = np.rint(waveletReconstruct(counts, positions, values, name, waveletLengths(name, colors), colors)).astype(np.int64)
+	reconstructed = np.maximum.accumulate(np.clip(reconstructed, 0, totals[:, np.newaxis]), axis=1)
+	reconstructed[:, -1] = totals
+	return reconstructed.astype(dtype).reshape((frames, regions, colors)), errors.reshape((frames, regions))
+
+# Return the quality of reconstructed cumulative histograms from their (..., colors) absolute differences to the true ones:
+# the sum of the differences in the # pixels below the qualityValues. Lower is better.
+def histQuality(diff):
+	return diff[..., np.asarray(qualityValues) - 1].sum(axis=-1)
+
+# Try every (wavelet, budget) on the (..., colors) cumulative histograms hists, as stored by waveletArray. Every wavelet takes
+# one decomposition of all histograms and one reconstruction of all histograms at every budget. Return (quality, stored),
+# (len(wavelets), len(budgets)) arrays of the mean quality (see histQuality) relative to the # pixels in the regions,
+# and the mean number of coefficients kept per histogram.
+def waveletSearch(hists, wavelets, budgets):
+	hists = np.asarray(hists)
+	colors = hists.shape[-1]
+	hists = hists.reshape((-1, colors)).astype(np.float64)
+	pixels = np.maximum(hists[:, -1], 1)
+	budgets = np.asarray(budgets)
+	quality = np.zeros((len(wavelets), len(budgets)))
+	stored = np.zeros((len(wavelets), len(budgets)))
+	for w, name in enumerate(wavelets):
+		lengths = waveletLengths(name, colors)
+		coeffs = np.concatenate(pywt.wavedec(hists, name, axis=1), axis=1)
+
+		# Rank of every coefficient by magnitude within its histogram, so every budget keeps the coefficients ranked below it
+		order = np.argsort(-np.abs(coeffs), axis=1)
+		rank = np.empty_like(order)
+		rank[np.arange(len(coeffs))[:, np.newaxis], order] = np.arange(coeffs.shape[1])
+		kept = np.where(rank < budgets[:, np.newaxis, np.newaxis], np.rint(coeffs), 0).reshape((-1, coeffs.shape[1]))
+
+		parts = np.split(kept, np.cumsum(lengths)[:-1], axis=1)
+		reconstructed = pywt.waverec(parts, name, axis=1)[:, :colors].reshape((len(budgets), len(hists), colors))
+		quality[w] = (histQuality(np.abs(reconstructed - hists)) / pixels).mean(axis=1)
+		stored[w] = (kept != 0).reshape((len(budgets), len(hists), -1)).sum(axis=2).mean(axis=1)
+	return quality, stored
+
+# Return at most count rows of the 2D array rows, spread evenly
+def evenRows(rows, count):
+	if len(rows) <= count:
+		return rows
+	return rows[np.linspace(0, len(rows)-1, count).astype(int)]
+
+# Return the (name, budget) wavelet to store the (..., colors) cumulative histograms hists with (e.g. all regions of a frame,
+# or of a sample of frames), chosen from the given wavelets and budgets (default: selectionWavelets and selectionBudgets)
+# with waveletSearch, on at most selectionHists of the histograms (after screening, see screenWavelets). Of the choices with a mean quality up to maxQuality, the one keeping the fewest coefficients is chosen,
+# and if there are none, the one with the best quality.
+def selectWavelet(hists, wavelets=None, budgets=None, maxQuality=maxQuality):
+	if wavelets is None:
+		if pywt is None:
+			raise ImportError("Wavelet layouts need the pywt module")
+		discrete = pywt.wavelist(kind="discrete")
+		wavelets = selectionWavelets if selectionWavelets is not None else [wave for family in pywt.families() for wave in pywt.wavelist(family) if wave in discrete]
+	if budgets is None:
+		budgets = selectionBudgets
+	hists = np.asarray(hists)
+	hists = evenRows(hists.reshape((-1, hists.shape[-1])), selectionHists)
+	if len(wavelets) > screenWavelets and len(hists) > screenHists:
+		# Keep the wavelets ranking best over all budgets
+		quality, stored = waveletSearch(evenRows(hists, screenHists), wavelets, budgets)
+		ranks = quality.argsort(axis=0).argsort(axis=0).mean(axis=1)
+		wavelets = [wavelets[w] for w in sorted(np.argsort(ranks, kind="mergesort")[:screenWavelets])]
+	quality, stored = waveletSearch(hists, wavelets, budgets)
+	good = zip(*np.nonzero(quality <= maxQuality))
+	if len(good) > 0:
+		w, b = min(good, key=lambda wb: (stored[wb], quality[wb]))
+	else:
+		w, b = np.unravel_index(np.argmin(quality), quality.shape)
+	if debug:
+		print "Chose wavelet {} with budget {}: quality {:.4f}, {:.1f} coefficients kept".format(wavelets[w], budgets[b], quality[w, b], stored[w, b])
+	return str(wavelets[w]), int(budgets[b])
+
+# As evaluateQueryOnRegions, on the wavelet histograms (see waveletFromBytes) of the queried regions, given by their
+# (frames, regions, colors) reconstruction and (frames, regions) error bounds. The true # pixels below a threshold value is
+# within the error bound of the reconstructed one (and between 0 and the # pixels), so between chooses the count used:
+#	"interpolate"	the reconstructed count
+#	"sure"			the most # pixels below the value within the bound, so only frames that surely match are found
+#	"possible"		the least # pixels below the value within the bound, so all frames that may match are found
+# Threshold values of 0, and of colors or more, are exact.
+def evaluateQueryOnWavelet(hists, errors, rules, between="interpolate"):
+	values = np.array([rule[0] for rule in rules], dtype=np.intp)
+	colors = hists.shape[2]
+	totals = hists[:, :, -1].astype(np.int64)
+	below = hists[:, :, np.clip(values - 1, 0, colors - 1)].astype(np.int64)
+	if between == "sure":
+		below = np.minimum(below + errors[:, :, np.newaxis], totals[:, :, np.newaxis])
+	elif between == "possible":
+		below = np.maximum(below - errors[:, :, np.newaxis].astype(np.int64), 0)
+	elif between != "interpolate":
+		raise ValueError("Unknown between {}, use interpolate, sure or possible".format(between))
+	below[:, :, values <= 0] = 0
+	below[:, :, values >= colors] = totals[:, :, np.newaxis]
+
+	totalPixels = totals.sum(axis=1)
+	pixelsAboveValue = totalPixels[:, np.newaxis] - below.sum(axis=1)
+	return answerQuery(pixelsAboveValue, totalPixels, np.array([rule[1] for rule in rules], dtype=np.float64))
+
+# Map the signed values stored wrapped in the unsigned array values to unsigned values: 0, -1, 1, -2, ... become 0, 1, 2, 3, ...
+def zigzag(values):
+	signed = values.view(np.dtype("i{}".format(values.dtype.itemsize)))
+	return ((signed << 1) ^ (signed >> (8*values.dtype.itemsize - 1))).view(values.dtype)
+
+# Inverse of zigzag
+def unzigzag(values):
+	return (values >> 1) ^ -(values & 1)
+
+# Return a uint8 array with the LEB128 varint encoding of the unsigned values in the 1D array values
+def varintEncode(values):
+	lengths = np.ones(len(values), dtype=np.intp)
+	for bits in range(7, 8*values.dtype.itemsize, 7):
+		lengths += values >= (1 << bits)
+	values = values.astype(np.uint64)
+	owner = np.repeat(np.arange(len(values)), lengths)
+	position = np.arange(len(owner)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+	encoded = ((values[owner] >> (7*position).astype(np.uint64)) & 0x7F).astype(np.uint8)
+	encoded[position < lengths[owner] - 1] |= 0x80
+	return encoded
+
+# Return the uint64 values encoded as LEB128 varints in the uint8 array encoded (see varintEncode)
+def varintDecode(encoded):
+	if len(encoded) == 0:
+		return np.zeros(0, dtype=np.uint64)
+	ends = np.flatnonzero(encoded < 0x80)
+	starts = np.concatenate(([0], ends[:-1] + 1)).astype(np.intp)
+	lengths = ends - starts + 1
+	values = (encoded[starts] & 0x7F).astype(np.uint64)
+	# Most values take a single byte, so only the few longer values are visited for every following byte
+	longer = np.flatnonzero(lengths > 1)
+	for byte in range(1, lengths.max()):
+		longer = longer[lengths[longer] > byte]
+		values[longer] |= (encoded[starts[longer] + byte] & 0x7F).astype(np.uint64) << np.uint64(7*byte)
+	return values
+
+# Return the bytes of a list of frame histograms (see histToFileLayout) stored with the given layout.
+def histToBytesLayout(hist, layout, wavelet=None):
+	return histLayoutArray(histToArray(hist), layout, wavelet).tobytes()
+
 # Write the histograms in a linear fashion, first all histograms from the first frame, then from the second and so on	
-def histToFileLinear(of, hist, intType, bf, selfTest=False):
-	intSize = struct.calcsize(intType)
-	writtenBytes = 0
-	# Fill the buffer before writing
-	for i in range(0, len(hist)):
-		frameHists = hist[i]
-	
-		for j in range(0, len(frameHists)):
-			cumRegionHist = frameHists[j]
-			struct.pack_into(intType*len(cumRegionHist), bf, writtenBytes, *cumRegionHist)
-			writtenBytes += intSize*len(cumRegionHist)
-	of.write(bf)
-	
-	if selfTest:
-		# Check that everything went correctly and that the histValFromFile method works
-		for i in range(0, len(hist)):
-			frameHists = hist[i]
-			for j in range(0, len(frameHists)):
-				for k in range(0, colors):
-					byteval = histValFromFileLinear(bf, len(hist), i, j, k)
-					realval = hist[i][j][k]
-					if realval - byteval != 0:
-						print "I: {} J: {} K: {}: Read {}. Expected {}.".format(i, j, k, byteval, realval)
+def histToFileLinear(of, stack):
+	histLayoutArray(stack, "linear").tofile(of)
 
 # Write the histograms in a binned fashion, with all 0-values from all histograms for all frames written linearly followed by 1s and so on
-def histToFileBinned(of, hist, intType, bf):
-	intSize = struct.calcsize(intType)
-	writtenBytes = 0
-	# assume all histograms have same size.
-	for k in range(0, len(hist[0][0])):
-		# write each number k from all histograms across all frames after each other
-		for i in range(0, len(hist)):
-			frameHists = hist[i]		
-		
-			for j in range(0, len(frameHists)):
-				cumRegionHist = frameHists[j]
-				struct.pack_into(intType, bf, writtenBytes, cumRegionHist[k])
-				writtenBytes += intSize
-	of.write(bf)
+def histToFileBinned(of, stack):
+	histLayoutArray(stack, "binned").tofile(of)
 					
 # Write the histograms in a region-linear fashion. The same region is written linearly across all frames, followed by the next region.
-def histToFileRegionLinear(of, hist, intType, bf):
-	intSize = struct.calcsize(intType)
-	writtenBytes=0
-	# Assume all frames have an equal number of regions (statically located)
-	for j in range(0, len(hist[0])):
-		# Write the selected region j in all frames linearly
-		for i in range(0, len(hist)):
-			cumRegionHist = hist[i][j]
-			struct.pack_into(intType*len(cumRegionHist), bf, writtenBytes, *cumRegionHist)
-			writtenBytes += intSize*len(cumRegionHist)
-	of.write(bf)
+def histToFileRegionLinear(of, stack):
+	histLayoutArray(stack, "reg-linear").tofile(of)
 	
 # Write the histograms in a region-binned fashion. The same region across all frames is written binned, followed by the next region.
-def histToFileRegionBinned(of, hist, intType, bf):
-	intSize = struct.calcsize(intType)
-	writtenBytes=0
-	# Assume all frames have an equal number of regions (statically located)
-	for j in range(0, len(hist[0])):
-	
-		# Write the selected region j in all frames binned
-		for k in range(0, len(hist[0][0])):
-			for i in range(0, len(hist)):
-				struct.pack_into(intType, bf, writtenBytes, hist[i][j][k])
-				writtenBytes += intSize
-	of.write(bf)
+def histToFileRegionBinned(of, stack):
+	histLayoutArray(stack, "reg-binned").tofile(of)
 
+# Name of the file a diff is written to by vid2diff.py: diff_height-width_fps_count.bin
+# fps is the number of diffs per second, count the number of the last video frame used for the diff.
+def diffFileName(height, width, fps, count):
+	return "diff_{}-{}_{:.1f}_{:04d}.bin".format(height, width, fps, count)
+
+# Return the (height, width, fps, count) encoded in the name of a diff file (see diffFileName), or None if the name isn't one.
+def diffFileInfo(name):
+	try:
+		size, fps, count = name[len("diff_"):-len(".bin")].split("_")
+		height, width = size.split("-")
+		return int(height), int(width), float(fps), int(count)
+	except ValueError:
+		return None
 
 # Given a 2D matrix of diff values in the range 0-255, write them to the file at path/name
 def diffToFile(path, name, diff):	
-	totalSize = 0
+	# Each number is byte, written row-wise straight from the (contiguous) array buffer
+	diff = np.ascontiguousarray(diff, dtype=np.ubyte)
 	with open(os.path.join(path, name), "wb") as of:
-		for i in range(0, len(diff)):
-			diffRow = diff[i]
-
-			# Each number is byte
-			val = struct.pack('B'*len(diffRow), *diffRow)
-			totalSize += len(val)
-			of.write(val)
+		diff.tofile(of)
 	
-	return totalSize	
+	return diff.nbytes
+
+
+# Diff pack: many diffs of the same size appended to a single file, instead of one file per diff.
+# Format:	header (magic, version, height, width), followed by all diffs stored as in diffToFile.
+#			When the pack is closed, an offset table with the offset and (diff file) name of every diff is appended,
+#			followed by a footer (offset of the table, number of diffs, magic).
+diffPackHeader = struct.Struct("<4sIII")
+diffPackEntry = struct.Struct("<QH")
+diffPackFooter = struct.Struct("<QI4s")
+diffPackMagic = "DIFP"
+diffPackVersion = 1
+
+# Write diffs to a diff pack at path/name. Call close() when all diffs have been appended, to write the offset table.
+class DiffPackWriter:
+	def __init__(self, path, name, height, width):
+		self.height = height
+		self.width = width
+		self.names = []
+		self.offsets = []
+		self.name = os.path.join(path, name)
+		self.of = open(self.name, "wb")
+		self.of.write(diffPackHeader.pack(diffPackMagic, diffPackVersion, height, width))
+		self.of.flush()
+		self.end = self.of.tell()
+
+	# Append a diff, stored under the given name. Return the number of bytes written.
+	def append(self, name, diff):
+		diff = np.ascontiguousarray(diff, dtype=np.ubyte)
+		self.of.seek(self.reserve(name))
+		diff.tofile(self.of)
+		return diff.nbytes
+
+	# Reserve space for a diff stored under the given name, without writing it. Return the offset of the diff.
+	# The diff can then be written by another process with diffToPackAt, while more diffs are appended/reserved.
+	def reserve(self, name):
+		offset = self.end
+		self.names.append(name)
+		self.offsets.append(offset)
+		self.end += self.height*self.width
+		return offset
+
+	def close(self):
+		tableOffset = self.end
+		self.of.seek(tableOffset)
+		for name, offset in zip(self.names, self.offsets):
+			self.of.write(diffPackEntry.pack(offset, len(name)))
+			self.of.write(name)
+		self.of.write(diffPackFooter.pack(tableOffset, len(self.names), diffPackMagic))
+		self.of.close()
+		diffPacks.pop(self.name, None)
+
+# Write a diff to the space reserved for it at offset in the diff pack with the given file name (see DiffPackWriter.reserve).
+# Return the number of bytes written.
+def diffToPackAt(name, offset, diff):
+	diff = np.ascontiguousarray(diff, dtype=np.ubyte)
+	with open(name, "r+b") as of:
+		of.seek(offset)
+		diff.tofile(of)
+	return diff.nbytes
+
+# Offset tables of diff packs that have been read, by file name, with the modification time and size of the file when read.
+diffPacks = {}
+
+# Return the list of diff names and the list of diff offsets in the diff pack with the given file name.
+# The offset table is read again if the pack was rewritten since it was read.
+def readDiffPack(name):
+	stat = os.stat(name)
+	if name not in diffPacks or diffPacks[name][0] != (stat.st_mtime, stat.st_size):
+		with open(name, "rb") as f:
+			f.seek(-diffPackFooter.size, os.SEEK_END)
+			tableOffset, count, magic = diffPackFooter.unpack(f.read(diffPackFooter.size))
+			if magic != diffPackMagic:
+				raise IOError("{} is not a closed diff pack".format(name))
+
+			f.seek(tableOffset)
+			names = []
+			offsets = []
+			for i in range(0, count):
+				offset, nameLength = diffPackEntry.unpack(f.read(diffPackEntry.size))
+				offsets.append(offset)
+				names.append(f.read(nameLength))
+		diffPacks[name] = ((stat.st_mtime, stat.st_size), (names, offsets))
+
+	return diffPacks[name][1]
+
+def isDiffPack(name):
+	return name.endswith(".diffpack")
 
 
 	
 
-# Execute the given command for the compression given.
-# Return the time spent to execute the command.
-def compressAndTime(compression, command, bytes_read, path, fileName):	
+# Compress bytes_read with the codec named compression (see compressors.py), and write the result to path/compression/fileName.compression.
+# Trained codecs need the dictionary they were trained with. Return the time spent compressing.
+def compressAndTime(compression, bytes_read, path, fileName, dictionary=None):	
+	codec = compressors.get(compression, dictionary)
 	st = time.clock()
-	bytes = eval(command)
+	bytes = codec.compress(bytes_read)
 	ut = time.clock() - st
 	ensureDir(path, compression)
 	with open(os.path.join(path, compression, fileName+"."+compression), "wb") as of:
 		of.write(bytes)
 	return ut
 				
-# Execute the given command for the compression given.
-# Return the time spent to execute the command.
-def decompressAndTime(compression, command, path, fileName):
+# Decompress the file path/compression/fileName.compression written by compressAndTime.
+# Return the time spent decompressing.
+def decompressAndTime(compression, path, fileName, dictionary=None):
+	codec = compressors.get(compression, dictionary)
 	dec_bytes = open(os.path.join(path, compression, fileName+"."+compression), "rb").read()
 	st = time.clock()
-	bytes = eval(command) #decompress the bytes
+	bytes = codec.decompress(dec_bytes)
 	ut = time.clock() - st
 	return ut
 	
@@ -354,15 +1066,9 @@ def decompressAndTime(compression, command, path, fileName):
 #	- quickLZ
 #	- LZO
 #
+# compressions is a list of codec names (see compressors.py), by default compressors.defaultCodecs.
 # Return the time spent to do the different compressions, timed using time.clock(), in a dictionary
-def compressFile(path, name):
-	timings = {
-		"snappy": {},
-		"zlib-6": {"lib": "zlib"},
-		"bz2-6": {"lib": "bz2"},
-		"lzma": {"lib": "pylzma"},
-		"lz4": {}
-	}
+def compressFile(path, name, compressions=None):
 	origFile = os.path.join(path, name)
 	
 	# Read bytes
@@ -370,19 +1076,47 @@ def compressFile(path, name):
 		print "Compressing file {}".format(origFile)
 	bytes_read = open(origFile, "rb").read()
 	
+	timings = compressBytes(path, name, bytes_read, compressions)
+		
+	if debug:
+		print "Done Compressing/Decompressing file {}".format(origFile)
+		
+	return timings
+
+# Worker: write a (frames, regions, colors) array of histograms with the given layout to path/layout/name.hist.layout (as histToFileLayout),
+# and compress the bytes written with the given compressions (as compressFile) without reading the file back.
+# Return the timings of the compressions (see compressBytes). wavelet is as in histLayoutArray.
+def compressHistograms(path, name, stack, layout, compressions=None, dictionaries=None, wavelet=None):
+	pathLayout = os.path.join(path, layout)
+	ensureDir(pathLayout)
+	fileName = name+".hist."+layout
+
+	bytes_read = histLayoutArray(stack, layout, wavelet).tobytes()
+	with open(os.path.join(pathLayout, fileName), "wb") as of:
+		of.write(bytes_read)
+	return compressBytes(pathLayout, fileName, bytes_read, compressions, dictionaries=dictionaries)
+
+# Compress bytes already in memory as if they were read from the file path/name, see compressFile.
+# compressions is a list of codec names (default: the codecs in compressors.defaultCodecs that are installed).
+# If timeDecompress is False, the compressed files are only written, and decompression is not timed.
+# dictionaries holds the trained dictionary of every trained codec in compressions (see compressors.trainDictionary).
+# Return the time spent to do the different compressions, timed using time.clock(), in a dictionary
+def compressBytes(path, name, bytes_read, compressions=None, timeDecompress=True, dictionaries=None):
+	if compressions is None:
+		compressions = compressors.available(compressors.defaultCodecs)
+	if dictionaries is None:
+		dictionaries = {}
+	timings = dict([(comp, {}) for comp in compressions])
+	
 	# Compress file with different compressors, and time them. Time spent reading/writing files is not included.
 	for comp, timeDic in timings.iteritems():
-		lib = timings[comp].get("lib", comp)
-		timings[comp]["compress"] = compressAndTime(comp, lib+".compress(bytes_read)", bytes_read, path, name)
+		timings[comp]["compress"] = compressAndTime(comp, bytes_read, path, name, dictionaries.get(comp))
 	
+	if not timeDecompress:
+		return timings
 	
 	# Also time decompression
 	for comp, timeDic in timings.iteritems():
-		lib = timings[comp].get("lib", comp)
-		timings[comp]["decompress"] = decompressAndTime(comp, lib+".decompress(dec_bytes)", path, name)
-		
-	if debug:
-		print "Done Compressing/Decompressing file {}".format(origFile)
+		timings[comp]["decompress"] = decompressAndTime(comp, path, name, dictionaries.get(comp))
 		
 	return timings
-	
\ No newline at end of file
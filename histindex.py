@@ -0,0 +1,592 @@
+import numpy as np
+import fileops
+import compressors
+import struct as struct
+import json
+import base64
+import bisect
+import collections
+import threading
+import os
+
+# Single-file index container, holding the compressed region histograms of a recording.
+#
+# Format:	header (magic, version, width, height, regCount, bins, framesPerBlock, fps, dtype, layout, codec),
+#			followed by the length of a JSON dictionary of extra settings and the dictionary itself.
+#			Indexes written with a trained codec (see compressors.trainDictionary) store its dictionary base64 encoded in the extras,
+#			once for the whole index.
+#
+#			Blocks follow the header. Every block is independently compressed and holds the histograms of up to
+#			framesPerBlock frames. A block starts with a block header (magic, number of frames, number of sections,
+#			payload length), followed by the timestamp of every frame in it, a section table (kind, length) and the sections.
+#			The "HIST" section holds the histograms of all frames in the block, stored with the layout and compressed with the codec.
+#			With bin edges (binEdges in the extras), only the bins at the edges and the last bin are stored (see fileops.quantizeHistograms).
+#			With a transform layout (see fileops.transformLayouts) the values are transformed before they are compressed,
+#			and with a truncated layout (see fileops.truncatedLayouts) only the values before the saturated tail are kept.
+#			With a wavelet layout (see fileops.waveletLayouts) the histograms are lossy: the section holds a few wavelet
+#			coefficients and an error bound per histogram, and the wavelet and budget are in the extras (wavelet).
+#			With region chunks (reg-linear and reg-binned layouts only), the "RCHK" section replaces it. It holds an offset table
+#			of regions+1 offsets, followed by the data of every region compressed separately, so a query only decompresses
+#			the regions it touches.
+#			With summed-area tables (satLevels in the extras), the "SATB" section holds, for every frame, a table per level plus one
+#			for all pixels, of (regCount+1, regCount+1) prefix sums over the region grid of the # pixels changed more than the
+#			level (see fileops.summedAreaTables). Rectangular queries at these levels then take four lookups per frame.
+#			With a summary (summaryLevels in the extras), the uncompressed "SUMM" section comes first. It holds for every region the
+#			maximum over the frames in the block of the # pixels changed at least each level ((regions, levels) "<u4" values),
+#			followed by the largest change in every region (regions "u1" values). Queries use it to skip blocks that can't match.
+#
+#			When the index is closed, an offset table with the first and last timestamp, offset and number of frames of
+#			every block is appended, followed by a footer (offset of the table, number of blocks, magic).
+#			Blocks are self-describing, so an index that hasn't been closed can still be read by scanning the block headers.
+#
+# Timestamps are the numbers of the video frames the diffs were made from. Divide by fps to get seconds into the video.
+
+indexHeader = struct.Struct("<4sIIIIIId8s16s16sI")
+blockHeader = struct.Struct("<4sIIQ")
+sectionEntry = struct.Struct("<4sQ")
+tableEntry = struct.Struct("<qqQI")
+indexFooter = struct.Struct("<QI4s")
+indexMagic = "HIDX"
+blockMagic = "BLCK"
+footerMagic = "HEND"
+indexVersion = 1
+
+# Levels of the block summaries written by default. Level 0 counts all pixels in a region.
+summaryLevels = [0, 5, 10, 20, 40, 80, 160]
+
+# Layouts storing all data of a region together, which can be written with region chunks
+regionLayouts = ["reg-linear", "reg-binned"]
+
+# Return the name of the index file for the given index parameters, stored next to the per-file index of diffcompress.py.
+def indexName(path, frames, regSize, layout, compression):
+	return os.path.join(path, "frames_"+str(frames), str(regSize), layout+"."+compression+".hidx")
+
+
+# Write an index to the file with the given name. Call close() when all blocks have been appended, to write the offset table.
+# dtype is chosen from the geometry, so the largest possible region histogram value always fits.
+# If regionChunks is True (only for layouts in regionLayouts), every region is compressed separately (see "RCHK" above).
+# If a list of satLevels (threshold values) is given, summed-area tables are stored for these levels (see "SATB" above).
+# Block summaries are stored for the given summaryLevels (see "SUMM" above), or not at all if it is None.
+# Trained codecs need the dictionary (bytes) to compress with, which is stored in the header.
+# If a list of binEdges (threshold values) is given, the histograms are quantized to these edges (see fileops.quantizeHistograms),
+# so queries are exact at the edges and bounded between them (see fileops.thresholdBins).
+# With a wavelet layout, histograms are stored with the (name, budget) wavelet (default: fileops.defaultWavelet).
+class IndexWriter:
+	def __init__(self, name, width, height, regCount, layout, codec, fps, framesPerBlock, colors=256, extras=None, regionChunks=False, satLevels=None, summaryLevels=summaryLevels, dictionary=None, binEdges=None, wavelet=None):
+		self.name = name
+		self.width = width
+		self.height = height
+		self.regCount = regCount
+		self.layout = layout
+		self.codec = codec
+		self.fps = fps
+		self.framesPerBlock = framesPerBlock
+		self.colors = colors
+		self.extras = extras if extras is not None else {}
+		if regionChunks:
+			if layout not in regionLayouts:
+				raise ValueError("Region chunks need one of the layouts {}, not {}".format(regionLayouts, layout))
+			self.extras["regionChunks"] = True
+		if satLevels:
+			self.extras["satLevels"] = sorted(set(satLevels))
+		if summaryLevels is not None:
+			self.extras["summaryLevels"] = sorted(set([0] + list(summaryLevels)))
+		if dictionary is not None:
+			self.extras["dictionary"] = base64.b64encode(dictionary)
+		if binEdges:
+			if min(binEdges) < 1 or max(binEdges) >= colors:
+				raise ValueError("Bin edges must be threshold values from 1 to {}, not {}".format(colors-1, binEdges))
+			self.extras["binEdges"] = sorted(set(binEdges))
+		if layout in fileops.waveletLayouts:
+			if binEdges:
+				raise ValueError("Bin edges can't be used with the lossy layout {}".format(layout))
+			waveletName, budget = wavelet if wavelet is not None else fileops.defaultWavelet
+			fileops.waveletLengths(waveletName, colors)
+			self.extras["wavelet"] = [waveletName, budget]
+		self.dtype = np.dtype(fileops.histDtype(fileops.maxRegionPixels(width, height, regCount)))
+		self.table = []
+
+		self.of = open(name, "wb")
+		extraBytes = json.dumps(self.extras)
+		self.of.write(indexHeader.pack(indexMagic, indexVersion, width, height, regCount, colors, framesPerBlock, fps, self.dtype.str, layout, codec, len(extraBytes)))
+		self.of.write(extraBytes)
+		self.of.flush()
+
+	# Append a block with the histograms of len(timestamps) frames. hist is a list of frame histograms (see fileops.histToFileLayout)
+	# and timestamps a list of the frame numbers of the frames. Timestamps must increase across blocks.
+	def appendBlock(self, timestamps, hist):
+		self.appendSections(timestamps, blockSections(hist, *self.encoding()))
+
+	# Return the arguments to blockSections after hist for blocks of this index, so blocks can be encoded elsewhere
+	# (e.g. in a worker process) and appended with appendSections.
+	def encoding(self):
+		return self.layout, self.codec, self.regCount, self.dtype.str, self.extras
+
+	# Append a block made from a list of (kind, bytes) sections.
+	def appendSections(self, timestamps, sections):
+		offset = self.of.tell()
+		self.of.write(blockHeader.pack(blockMagic, len(timestamps), len(sections), sum(len(data) for kind, data in sections)))
+		self.of.write(np.asarray(timestamps, dtype="<i8").tobytes())
+		for kind, data in sections:
+			self.of.write(sectionEntry.pack(kind, len(data)))
+		for kind, data in sections:
+			self.of.write(data)
+		self.of.flush()
+		self.table.append((timestamps[0], timestamps[-1], offset, len(timestamps)))
+
+	# Append all blocks of the closed index with the given name, written with the same parameters (e.g. by another process
+	# for a later part of the same recording), to this index. The blocks are copied as they are, without decompressing them.
+	def appendIndex(self, name):
+		reader = IndexReader(name)
+		if (reader.regCount, reader.layout, reader.codec, reader.dtype, reader.extras) != (self.regCount, self.layout, self.codec, self.dtype, self.extras):
+			raise ValueError("Can't append index {} to {}, as it was written with different parameters".format(name, self.name))
+
+		start = self.of.tell()
+		reader.f.seek(reader.dataOffset)
+		remaining = reader.dataEnd - reader.dataOffset
+		while remaining > 0:
+			data = reader.f.read(min(remaining, 1 << 20))
+			self.of.write(data)
+			remaining -= len(data)
+		self.of.flush()
+		for first, last, offset, count in zip(reader.firsts, reader.lasts, reader.offsets, reader.counts):
+			self.table.append((first, last, offset - reader.dataOffset + start, count))
+		reader.close()
+
+	def close(self):
+		tableOffset = self.of.tell()
+		for entry in self.table:
+			self.of.write(tableEntry.pack(*entry))
+		self.of.write(indexFooter.pack(tableOffset, len(self.table), footerMagic))
+		self.of.close()
+
+
+# Least recently used cache of decompressed index data, keyed by (index file, block id, part of the block).
+# Index files are identified by path, modification time and size, so an index rebuilt in place is never served from old entries.
+# Can be shared by any number of IndexReaders. Holds at most maxBytes bytes of arrays, evicting the least recently used entries.
+class BlockCache:
+	def __init__(self, maxBytes):
+		self.maxBytes = maxBytes
+		self.bytes = 0
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	# Return the value stored for key, or None if it isn't cached
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is None:
+				self.misses += 1
+				return None
+			self.entries[key] = entry
+			self.hits += 1
+			return entry[0]
+
+	# Store value, taking up nbytes, for key. Values larger than the cache are not stored.
+	def put(self, key, value, nbytes):
+		with self.lock:
+			if key in self.entries:
+				self.bytes -= self.entries.pop(key)[1]
+			if nbytes > self.maxBytes:
+				return
+			self.entries[key] = (value, nbytes)
+			self.bytes += nbytes
+			while self.bytes > self.maxBytes:
+				oldKey, (oldValue, oldBytes) = self.entries.popitem(last=False)
+				self.bytes -= oldBytes
+				self.evictions += 1
+
+	def toStr(self):
+		return "{} hits, {} misses, {} evictions, {} entries using {:.1f} of {:.1f} MB".format(self.hits, self.misses, self.evictions, len(self.entries), self.bytes/1e6, self.maxBytes/1e6)
+
+
+# Return the list of (kind, bytes) sections of a block with the histograms in hist (see IndexWriter.appendBlock),
+# for an index with the given layout, codec, regCount, dtype and extras (see IndexWriter.encoding).
+def blockSections(hist, layout, codec, regCount, dtype, extras):
+	stack = np.asarray(hist).astype(dtype)
+	stored = stack
+	if "binEdges" in extras:
+		stored = fileops.quantizeHistograms(stack, extras["binEdges"])
+	data = fileops.histLayoutArray(stored, layout, extras.get("wavelet"))
+	sections = []
+	if "summaryLevels" in extras:
+		maxAbove, maxDiff = fileops.histSummary(stack, extras["summaryLevels"])
+		sections.append(("SUMM", maxAbove.astype("<u4").tobytes() + maxDiff.astype("u1").tobytes()))
+	if extras.get("regionChunks", False):
+		sections.append(("RCHK", regionChunkSection(data, indexCodec(codec, extras))))
+	else:
+		sections.append(("HIST", indexCodec(codec, extras).compress(data.tobytes())))
+	if "satLevels" in extras:
+		tables = fileops.summedAreaTables(stack, extras["satLevels"], regCount)
+		sections.append(("SATB", indexCodec(codec, extras).compress(tables.astype("<u4").tobytes())))
+	return sections
+
+# Return the codec (see compressors.py) with the given name of an index with the given extras, using the dictionary stored in them if there is one
+def indexCodec(codec, extras):
+	if "dictionary" in extras:
+		return compressors.get(codec, base64.b64decode(extras["dictionary"]))
+	return compressors.get(codec)
+
+# Return the "RCHK" section for data stored with a region layout: offset table followed by the compressed regions
+def regionChunkSection(data, codec):
+	chunks = [codec.compress(data[j].tobytes()) for j in range(0, len(data))]
+	offsets = np.concatenate(([0], np.cumsum([len(chunk) for chunk in chunks])))
+	return offsets.astype("<u4").tobytes() + "".join(chunks)
+
+
+# Read an index written by IndexWriter. The offset table is read when opening the index, and blocks are read on request.
+# If a BlockCache is given, decompressed histograms, summed-area tables and summaries are kept in it, so repeated
+# queries on the same blocks don't read and decompress them again.
+class IndexReader:
+	def __init__(self, name, cache=None):
+		self.name = name
+		self.cache = cache
+		self.f = open(name, "rb")
+		stat = os.fstat(self.f.fileno())
+		self.cacheKey = (os.path.abspath(name), stat.st_mtime, stat.st_size)
+		magic, version, self.width, self.height, self.regCount, self.colors, self.framesPerBlock, self.fps, dtype, layout, codec, extraLength = indexHeader.unpack(self.f.read(indexHeader.size))
+		if magic != indexMagic:
+			raise IOError("{} is not an index".format(name))
+		self.dtype = np.dtype(dtype.rstrip("\0"))
+		self.layout = layout.rstrip("\0")
+		self.codec = codec.rstrip("\0")
+		self.extras = json.loads(self.f.read(extraLength))
+		self.regionChunks = self.extras.get("regionChunks", False)
+		self.satLevels = self.extras.get("satLevels", [])
+		self.summaryLevels = self.extras.get("summaryLevels", [])
+		# Bin edges the histograms are quantized to (or None), and the number of bins stored per histogram
+		self.binEdges = self.extras.get("binEdges")
+		self.bins = len(self.binEdges) + 1 if self.binEdges else self.colors
+		self.decompressor = indexCodec(self.codec, self.extras).decompress
+		self.dataOffset = self.f.tell()
+
+		# Number of bytes output by the codec when decompressing, and number of blocks skipped using summaries, to measure the work done by queries
+		self.bytesDecompressed = 0
+		self.blocksSkipped = 0
+
+		# Offset table: first and last timestamp, offset and number of frames of every block
+		self.firsts = []
+		self.lasts = []
+		self.offsets = []
+		self.counts = []
+		# End of the last block found by scanning, or None if the offset table of a closed index was read.
+		# dataEnd is the end of the blocks in both cases.
+		self.scanEnd = None
+		if not self.readTable():
+			self.scanEnd = self.scanBlocks(self.dataOffset)
+			self.dataEnd = self.scanEnd
+
+	def close(self):
+		self.f.close()
+
+	def blockCount(self):
+		return len(self.offsets)
+
+	def addEntry(self, first, last, offset, count):
+		self.firsts.append(first)
+		self.lasts.append(last)
+		self.offsets.append(offset)
+		self.counts.append(count)
+
+	# Read the offset table at the end of a closed index. Return False if the index hasn't been closed.
+	def readTable(self):
+		self.f.seek(0, os.SEEK_END)
+		if self.f.tell() - self.dataOffset < indexFooter.size:
+			return False
+		self.f.seek(-indexFooter.size, os.SEEK_END)
+		tableOffset, count, magic = indexFooter.unpack(self.f.read(indexFooter.size))
+		self.dataEnd = tableOffset
+		if magic != footerMagic:
+			return False
+
+		self.f.seek(tableOffset)
+		table = self.f.read(count*tableEntry.size)
+		for i in range(0, count):
+			self.addEntry(*tableEntry.unpack_from(table, i*tableEntry.size))
+		return True
+
+	# Build the offset table by reading block headers from offset and on, skipping the block payloads.
+	# Stops at the end of the file, at an incompletely written block or at the offset table of a closed index.
+	def scanBlocks(self, offset):
+		self.f.seek(0, os.SEEK_END)
+		end = self.f.tell()
+		while offset + blockHeader.size <= end:
+			self.f.seek(offset)
+			magic, count, sectionCount, payloadLength = blockHeader.unpack(self.f.read(blockHeader.size))
+			blockLength = blockHeader.size + 8*count + sectionEntry.size*sectionCount + payloadLength
+			if magic != blockMagic or offset + blockLength > end:
+				break
+			timestamps = np.frombuffer(self.f.read(8*count), dtype="<i8")
+			self.addEntry(int(timestamps[0]), int(timestamps[-1]), offset, count)
+			offset += blockLength
+		return offset
+
+	# Add the blocks appended since the index was opened (or last refreshed), for an index that is still being written.
+	# Return the number of blocks added.
+	def refresh(self):
+		if self.scanEnd is None:
+			return 0
+		count = self.blockCount()
+		self.scanEnd = self.scanBlocks(self.scanEnd)
+		self.dataEnd = self.scanEnd
+		return self.blockCount() - count
+
+	# Return the ids of the blocks holding frames with timestamps in the range first to last (both included)
+	def blocksInRange(self, first, last):
+		start = bisect.bisect_left(self.lasts, first)
+		end = bisect.bisect_right(self.firsts, last)
+		return range(start, max(start, end))
+
+	# Return the timestamps and a dictionary of the (still compressed) sections of block i
+	def readBlock(self, i):
+		self.f.seek(self.offsets[i])
+		magic, count, sectionCount, payloadLength = blockHeader.unpack(self.f.read(blockHeader.size))
+		timestamps = np.frombuffer(self.f.read(8*count), dtype="<i8")
+		entries = [sectionEntry.unpack(self.f.read(sectionEntry.size)) for s in range(0, sectionCount)]
+		sections = {}
+		for kind, length in entries:
+			sections[kind] = self.f.read(length)
+		return timestamps, sections
+
+	# Return the timestamps and a single (still compressed) section of block i, without reading the other sections
+	def readSection(self, i, kind):
+		self.f.seek(self.offsets[i])
+		magic, count, sectionCount, payloadLength = blockHeader.unpack(self.f.read(blockHeader.size))
+		timestamps = np.frombuffer(self.f.read(8*count), dtype="<i8")
+		entries = [sectionEntry.unpack(self.f.read(sectionEntry.size)) for s in range(0, sectionCount)]
+		offset = 0
+		for entryKind, length in entries:
+			if entryKind == kind:
+				self.f.seek(offset, os.SEEK_CUR)
+				return timestamps, self.f.read(length)
+			offset += length
+		raise KeyError("Block {} of {} has no {} section".format(i, self.name, kind))
+
+	# Return the summary of block i: the (regions, len(summaryLevels)) maximum # pixels changed at least each level, and the largest change per region
+	def blockSummary(self, i):
+		summary = self.cacheGet(i, "SUMM")
+		if summary is None:
+			timestamps, section = self.readSection(i, "SUMM")
+			regions = self.regCount*self.regCount
+			maxAbove = np.frombuffer(section, dtype="<u4", count=regions*len(self.summaryLevels)).reshape((regions, len(self.summaryLevels)))
+			maxDiff = np.frombuffer(section, dtype="u1", offset=4*regions*len(self.summaryLevels))
+			summary = self.cachePut(i, "SUMM", (maxAbove, maxDiff))
+		return summary
+
+	# Return the cached value of part of block i, or None if there is no cache or it isn't cached
+	def cacheGet(self, i, part):
+		if self.cache is None:
+			return None
+		return self.cache.get((self.cacheKey, i, part))
+
+	# Cache a tuple of arrays as part of block i, and return it. Arrays are made contiguous and read-only, as they are shared by all queries.
+	def cachePut(self, i, part, value):
+		if self.cache is None:
+			return value
+		value = tuple(np.ascontiguousarray(array) for array in value)
+		for array in value:
+			array.flags.writeable = False
+		self.cache.put((self.cacheKey, i, part), value, sum(array.nbytes for array in value))
+		return value
+
+	def decompress(self, data):
+		bytes = self.decompressor(data)
+		self.bytesDecompressed += len(bytes)
+		return bytes
+
+	# Return the timestamps and the histograms of block i, as a (frames, regCount*regCount, bins) array.
+	# With bin edges, these are the quantized histograms (see fileops.quantizeHistograms), else bins is colors.
+	# With a wavelet layout, these are the reconstructed histograms (see fileops.waveletFromBytes).
+	def blockHistograms(self, i):
+		if self.layout in fileops.waveletLayouts:
+			return self.blockWavelet(i)[:2]
+
+		if self.layout in fileops.truncatedLayouts:
+			block = self.blockTruncated(i)
+			return block[0], fileops.histFromTruncated(*block[1:], colors=self.bins)
+
+		if self.layout in fileops.transformLayouts:
+			timestamps, values = self.blockTransformed(i)
+			return timestamps, fileops.histFromTransformed(values, self.layout)
+
+		if self.regionChunks:
+			regions = range(0, self.regCount*self.regCount)
+			timestamps, regionHists = self.blockRegions(i, regions)
+			return timestamps, np.array([regionHists[region] for region in regions]).transpose((1, 0, 2))
+
+		block = self.cacheGet(i, "HIST")
+		if block is None:
+			timestamps, sections = self.readBlock(i)
+			bytes = self.decompress(sections["HIST"])
+			block = self.cachePut(i, "HIST", (timestamps, fileops.histFromBytesLayout(bytes, self.layout, self.regCount*self.regCount, self.bins, self.dtype)))
+		return block
+
+	# Return the timestamps and the values of block i of an index with a transform layout, as a (frames, regCount*regCount, bins)
+	# array (see fileops.transformedFromBytes). Queries undo the transforms on the regions they need only.
+	def blockTransformed(self, i):
+		block = self.cacheGet(i, "TRNS")
+		if block is None:
+			timestamps, sections = self.readBlock(i)
+			bytes = self.decompress(sections["HIST"])
+			block = self.cachePut(i, "TRNS", (timestamps, fileops.transformedFromBytes(bytes, self.layout, self.regCount*self.regCount, self.bins, self.dtype)))
+		return block
+
+	# Return the timestamps and the truncated histograms (lengths, offsets, values) of block i of an index with a truncated layout
+	# (see fileops.truncatedFromBytes). Queries look threshold values up in them directly.
+	def blockTruncated(self, i):
+		block = self.cacheGet(i, "TRUN")
+		if block is None:
+			timestamps, sections = self.readBlock(i)
+			bytes = self.decompress(sections["HIST"])
+			block = self.cachePut(i, "TRUN", (timestamps,) + fileops.truncatedFromBytes(bytes, self.layout, self.regCount*self.regCount, self.dtype))
+		return block
+
+	# Return the timestamps, reconstructed histograms and error bounds of block i of an index with a wavelet layout
+	# (see fileops.waveletFromBytes)
+	def blockWavelet(self, i):
+		block = self.cacheGet(i, "WAVE")
+		if block is None:
+			timestamps, sections = self.readBlock(i)
+			bytes = self.decompress(sections["HIST"])
+			block = self.cachePut(i, "WAVE", (timestamps,) + fileops.waveletFromBytes(bytes, self.regCount*self.regCount, self.colors, self.dtype))
+		return block
+
+	# Return the timestamps of block i, and a dictionary with the histograms of the given regions (index i*regCount + j
+	# for the region in row i, column j) as (frames, bins) arrays. With region chunks, only those regions are decompressed.
+	def blockRegions(self, i, regions):
+		if not self.regionChunks:
+			timestamps, hists = self.blockHistograms(i)
+			return timestamps, dict([(region, hists[:, region]) for region in regions])
+
+		# Regions are cached separately, so only the regions not cached yet are decompressed
+		timestamps = None
+		regionHists = {}
+		for region in regions:
+			cached = self.cacheGet(i, region)
+			if cached is not None:
+				timestamps, regionHists[region] = cached
+		missing = [region for region in regions if region not in regionHists]
+		if len(missing) == 0 and timestamps is not None:
+			return timestamps, regionHists
+
+		timestamps, sections = self.readBlock(i)
+		section = sections["RCHK"]
+		offsetBytes = 4*(self.regCount*self.regCount + 1)
+		offsets = np.frombuffer(section[:offsetBytes], dtype="<u4")
+		for region in missing:
+			data = np.frombuffer(self.decompress(section[offsetBytes+offsets[region]:offsetBytes+offsets[region+1]]), dtype=self.dtype)
+			if self.layout == "reg-linear":
+				data = data.reshape((len(timestamps), self.bins))
+			else:
+				data = data.reshape((self.bins, len(timestamps))).T
+			timestamps, regionHists[region] = self.cachePut(i, region, (timestamps, data))
+		return timestamps, regionHists
+
+	# Return the timestamps and the summed-area tables of block i, as a "<u4" (frames, len(satLevels)+1, regCount+1, regCount+1) array
+	def blockSummedAreas(self, i):
+		block = self.cacheGet(i, "SATB")
+		if block is None:
+			timestamps, sections = self.readBlock(i)
+			tables = np.frombuffer(self.decompress(sections["SATB"]), dtype="<u4")
+			block = self.cachePut(i, "SATB", (timestamps, tables.reshape((len(timestamps), len(self.satLevels)+1, self.regCount+1, self.regCount+1))))
+		return block
+
+	# Return the bins to look up to count the pixels changed less than every threshold value in values (see fileops.thresholdBins)
+	def thresholdBins(self, values, between="interpolate"):
+		return fileops.thresholdBins(values, self.binEdges, between, self.colors)
+
+	# Return the timestamp (frame number) of the frame at the given number of seconds into the video
+	def timestampAt(self, seconds):
+		return int(round(seconds*self.fps))
+
+	# Return the number of seconds into the video of the frame with the given timestamp
+	def secondsAt(self, timestamp):
+		return timestamp / float(self.fps)
+
+
+# Answer a query (see fileops.queryOnHistogram) on all frames in index with timestamps in the range first to last (both included).
+# Only the blocks overlapping the range are read and decompressed, so the time spent depends on the size of the range,
+# not on the length of the recording. Return the list of timestamps of frames matching the query.
+# With bin edges, threshold values between edges are answered as chosen by between (see fileops.thresholdBins),
+# and so are all threshold values with a wavelet layout (see fileops.evaluateQueryOnWavelet).
+def queryRange(index, first, last, queryArea, thresholdValue, thresholdFrac, between="interpolate"):
+	return queryRangeRules(index, first, last, queryArea, [(thresholdValue, thresholdFrac)], between)[0]
+
+# As queryRange, for a list of rules [(thresholdValue, thresholdFrac), ...] on the same queryArea.
+# Every block is decompressed once for all rules. Return a list of matching timestamps per rule.
+# If queryArea is a rectangle and the index has summed-area tables for all threshold values, only the tables are used,
+# unless decompressing the histograms of the queried regions is less work (with region chunks). Summed-area tables are
+# made from the full histograms, so they are always used for threshold values between bin edges, where they are exact.
+def queryRangeRules(index, first, last, queryArea, rules, between="interpolate"):
+	# Regions touched by the query. Only these are decompressed if the index has region chunks.
+	mask = fileops.queryMask(index.regCount, queryArea)
+	regions = list(np.flatnonzero(mask))
+
+	rect = fileops.queryRectangle(queryArea)
+	if rect is not None and all(rule[0] in index.satLevels for rule in rules):
+		levels = [index.satLevels.index(rule[0]) for rule in rules]
+		fracs = np.array([rule[1] for rule in rules], dtype=np.float64)
+		tableBytes = 4*(len(index.satLevels)+1)*(index.regCount+1)*(index.regCount+1)
+		exact = not index.binEdges or all(rule[0] in index.binEdges for rule in rules)
+		if index.regionChunks and exact and len(regions)*index.bins*index.dtype.itemsize < tableBytes:
+			rect = None
+	else:
+		rect = None
+	lookup = index.thresholdBins([rule[0] for rule in rules], between)
+
+	# With bin edges, blocks are skipped as if every threshold value was the edge at or below it. No answer between edges
+	# counts more pixels than the one at that edge, so no block that could match is skipped.
+	skipRules = rules
+	if index.binEdges:
+		points = [0] + index.binEdges
+		skipRules = [(points[bisect.bisect_right(points, thresholdValue) - 1], thresholdFrac) for thresholdValue, thresholdFrac in rules]
+
+	matches = [[] for rule in rules]
+	for b in index.blocksInRange(first, last):
+		if len(index.summaryLevels) > 0 and not blockMayMatch(index, b, regions, skipRules):
+			index.blocksSkipped += 1
+			continue
+
+		if rect is not None:
+			timestamps, tables = index.blockSummedAreas(b)
+			sums = fileops.rectangleSums(tables, rect)
+			answers = fileops.answerQuery(sums[:, levels], sums[:, -1], fracs)
+		elif index.layout in fileops.waveletLayouts:
+			timestamps, hists, errors = index.blockWavelet(b)
+			answers = fileops.evaluateQueryOnWavelet(hists[:, regions], errors[:, regions], rules, between)
+		elif index.layout in fileops.truncatedLayouts:
+			timestamps, lengths, offsets, values = index.blockTruncated(b)
+			answers = fileops.evaluateQueryOnTruncated(lengths[:, regions], offsets[:, regions], values, rules, lookup)
+		elif index.layout in fileops.transformLayouts:
+			timestamps, values = index.blockTransformed(b)
+			answers = fileops.evaluateQueryOnTransformed(values[:, regions], index.layout, rules, lookup)
+		else:
+			timestamps, regionHists = index.blockRegions(b, regions)
+			hists = np.stack([regionHists[region] for region in regions], axis=1)
+			answers = fileops.evaluateQueryOnRegions(hists, rules, lookup)
+		inRange = (timestamps >= first) & (timestamps <= last)
+		for r in range(len(rules)):
+			matches[r].extend(int(timestamp) for timestamp in timestamps[answers[r] & inRange])
+	return matches
+
+# Return False if the summary of block b shows that no frame in it can match any of the rules on the given regions.
+# The # pixels changed at least thresholdValue in a region is at most the maximum at the largest summary level not above thresholdValue,
+# and 0 if the largest change in the region is smaller than thresholdValue.
+def blockMayMatch(index, b, regions, rules):
+	maxAbove, maxDiff = index.blockSummary(b)
+	totalPixels = maxAbove[regions, 0].sum(dtype=np.int64)
+	for thresholdValue, thresholdFrac in rules:
+		level = bisect.bisect_right(index.summaryLevels, thresholdValue) - 1
+		counts = np.where(maxDiff[regions] >= thresholdValue, maxAbove[regions, level], 0)
+		if totalPixels > 0 and counts.sum(dtype=np.int64) / float(totalPixels) > thresholdFrac:
+			return True
+	return False
+
+# Answer a query on all frames in index between start and end seconds into the video (both included), see queryRange.
+# Return the list of times (in seconds into the video) of frames matching the query.
+def queryTimeRange(index, start, end, queryArea, thresholdValue, thresholdFrac, between="interpolate"):
+	matches = queryRange(index, index.timestampAt(start), index.timestampAt(end), queryArea, thresholdValue, thresholdFrac, between)
+	return [index.secondsAt(timestamp) for timestamp in matches]
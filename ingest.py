@@ -0,0 +1,289 @@
+import numpy as np
+import fileops
+import compressors
+import histindex
+import pipeline
+import cv2
+import os
+import sys
+import time
+import json
+import argparse
+import threading
+import collections
+import Queue as queue
+from multiprocessing import Pool, cpu_count
+from fractions import gcd
+
+# General idea:
+# - Index many cameras (video files or live streams) at once, as vid2index.py does for one, writing index files only.
+# - Every camera is decoded on its own thread into a bounded queue of diffs. When the queue is full, decoding waits (backpressure).
+# - Diffs are grouped into jobs of lcm(frames) diffs. Jobs are histogrammed and compressed on a single pool of worker processes,
+#   sized to the number of cores, so adding cameras never oversubscribes the machine.
+# - Cameras take turns submitting jobs (round robin), and each camera has at most --inflight jobs running, so a busy camera can't starve the others.
+# - Finished jobs are appended to the index files of their camera in order. The lag of every camera is reported regularly.
+#
+# The cameras are read from a JSON file with a list of cameras. Every camera is a dictionary with the keys:
+#	name			names the output directory, outDir/diff-${name}_${interval}
+#	source			video file, stream URL or device number
+#	interval		the number of frames between diffs (as in vid2diff.py)
+#	regions, frames, layouts, compressions	index parameters (as in vid2index.py), optional
+#	wavelet			[name, budget] of the wavelet layout (as --wavelet and --budget of vid2index.py), or "auto" to choose
+#					it on the first job of the camera (see pipeline.chooseWavelet), optional
+#	width, height	resolution frames are scaled to before diffing, optional
+#	fps				frame rate, if the source doesn't report it correctly, optional
+#	live			true for live streams, which are read until they fail, optional
+
+
+#####################################################
+###### HERE ARE THE OPTIONS THAT CAN BE CHANGED #####
+#####################################################
+
+# JSON file with the list of cameras
+configFile = "cameras.json"
+
+# Directory the index files are written to
+outDir = "tests"
+
+# Index parameters used for cameras that don't set them
+regSizes = [4, 8, 16, 32]
+frames = [1, 10]
+layouts = ["linear"]
+compressions = ["zlib-6"]
+
+# Worker processes shared by all cameras
+processes = cpu_count()
+
+# Maximum number of jobs running per camera
+inFlight = 2
+
+# Maximum number of decoded diffs waiting per camera
+queueSize = 32
+
+# Maximum number of seconds a diff waits before it is submitted in a (partial) job, for slow live cameras
+maxLatency = 5.0
+
+# Seconds between lag reports
+reportInterval = 5.0
+
+# Cols = Different pixel values
+cols = 256
+
+
+#####################################################
+##### HERE BE PARSING OF COMMAND LINE ARGUMENTS #####
+#####################################################
+
+parser = argparse.ArgumentParser(description='Arguments')
+parser.add_argument('--config', dest='config', action='store', default=configFile, help='JSON file with the list of cameras')
+parser.add_argument('--out', dest='out', action='store', default=outDir, help='directory the index files are written to')
+parser.add_argument('--processes', dest='processes', type=int, action='store', default=processes, help='the number of worker processes shared by all cameras')
+parser.add_argument('--inflight', dest='inflight', type=int, action='store', default=inFlight, help='the maximum number of jobs running per camera')
+parser.add_argument('--queue', dest='queue', type=int, action='store', default=queueSize, help='the maximum number of decoded diffs waiting per camera')
+parser.add_argument('--latency', dest='latency', type=float, action='store', default=maxLatency, help='the maximum number of seconds a diff waits before it is submitted')
+parser.add_argument('--report', dest='report', type=float, action='store', default=reportInterval, help='the number of seconds between lag reports')
+parser.add_argument('--satlevels', dest='satlevels', type=int, action='store', default=None, nargs='+', help='threshold values to store summed-area tables for in index files, for fast rectangular queries')
+parser.add_argument('--binedges', dest='binedges', type=int, action='store', default=None, nargs='+', help='threshold values to quantize the histograms in index files to; queries are exact at these values and bounded between them')
+
+args = parser.parse_args()
+
+
+# A camera being indexed: its decoder thread, queue of decoded diffs, jobs running and index files
+class Camera:
+	def __init__(self, config):
+		self.name = config["name"]
+		self.interval = config["interval"]
+		self.regSizes = config.get("regions", regSizes)
+		self.frames = config.get("frames", frames)
+		self.layouts = [str(layout) for layout in config.get("layouts", layouts)] # JSON strings are unicode
+		self.compressions = [str(compression) for compression in config.get("compressions", compressions)]
+		for codec, reason in compressors.unavailable(self.compressions).items():
+			raise ValueError("Camera {}: codec {} can't be used: {}".format(self.name, codec, reason))
+		for codec in self.compressions:
+			if compressors.isTrained(codec):
+				raise ValueError("Camera {}: codec {} needs a trained dictionary, which only diffcompress.py trains".format(self.name, codec))
+		self.wavelet = config.get("wavelet")
+		if self.wavelet is not None and self.wavelet != "auto":
+			self.wavelet = (str(self.wavelet[0]), self.wavelet[1])
+		self.live = config.get("live", False)
+		self.path = os.path.join(args.out, "diff-"+self.name+"_{}".format(self.interval))
+		fileops.ensureDir(self.path)
+
+		# Jobs hold a multiple of every # frames per block, so only the last job of a video writes partial blocks
+		self.jobSize = reduce(lambda a, b: a*b/gcd(a, b), self.frames)
+
+		source = config["source"]
+		self.capture = cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+		self.fps = config.get("fps", self.capture.get(cv2.cv.CV_CAP_PROP_FPS))
+		if self.fps <= 0:
+			raise ValueError("Camera {}: the source reports a frame rate of {}, set it with the fps key".format(self.name, self.fps))
+		size = (config["width"], config["height"]) if "width" in config else None
+
+		self.queue = queue.Queue(maxsize=args.queue)
+		self.decoder = threading.Thread(target=pipeline.decodeDiffs, args=(self.capture, self.interval, self.queue, self.live, size))
+		self.decoder.daemon = True
+
+		self.ended = False
+		self.error = None
+		self.diffs = []
+		self.timestamps = []
+		self.waitingSince = None
+		self.running = collections.deque()
+		self.indexWriters = {}
+		self.encodings = {}
+		self.decoded = 0
+		self.indexed = 0
+		self.lastIndexed = 0
+		self.busy = 0.0
+
+	def start(self):
+		self.started = time.time()
+		self.decoder.start()
+
+	# Open the index files for the (N, height, width) diffs of the first job, once their size is known.
+	# The wavelet is chosen on these diffs if it is "auto".
+	def openIndexes(self, diffs):
+		if self.wavelet == "auto":
+			self.wavelet = pipeline.chooseWavelet(self.path, diffs, self.regSizes, self.layouts, cols)
+		height, width = diffs.shape[1:]
+		for i in self.frames:
+			for regSize in self.regSizes:
+				fileops.ensureDir(os.path.join(self.path, "frames_"+str(i), str(regSize)))
+				for layout in self.layouts:
+					for compression in self.compressions:
+						key = (i, regSize, layout, compression)
+						self.indexWriters[key] = histindex.IndexWriter(histindex.indexName(self.path, i, regSize, layout, compression), width, height, regSize, layout, compression, self.fps, i, cols, satLevels=args.satlevels, binEdges=args.binedges, wavelet=self.wavelet)
+						self.encodings[key] = self.indexWriters[key].encoding()
+
+	# Return the (diffs, timestamps) of the next job if it is ready, or None. A job is ready when it holds jobSize diffs,
+	# when its first diff has waited --latency seconds, or at the end of the video.
+	def takeJob(self):
+		while len(self.diffs) < self.jobSize and not self.ended:
+			try:
+				item = self.queue.get_nowait()
+			except queue.Empty:
+				break
+			if item is pipeline.endOfStream:
+				self.ended = True
+				break
+			if isinstance(item, Exception):
+				# The decoder failed. The camera ends with the diffs decoded so far, while the others go on.
+				self.error = item
+				print "Camera {} failed: {}".format(self.name, item)
+				continue
+			count, diff = item
+			if self.waitingSince is None:
+				self.waitingSince = time.time()
+			self.diffs.append(diff)
+			self.timestamps.append(count)
+			self.decoded += 1
+
+		if len(self.diffs) == 0:
+			return None
+		if len(self.diffs) == self.jobSize or self.ended or time.time() - self.waitingSince >= args.latency:
+			job = (np.array(self.diffs), self.timestamps)
+			if len(self.indexWriters) == 0:
+				self.openIndexes(job[0])
+			self.diffs = []
+			self.timestamps = []
+			self.waitingSince = None
+			return job
+		return None
+
+	# Append the blocks of finished jobs to the index files, in the order the jobs were submitted. Return the # jobs appended.
+	def collect(self):
+		appended = 0
+		while len(self.running) > 0 and self.running[0][1].ready():
+			timestamps, result = self.running.popleft()
+			blocks, busy = result.get()
+			for key, keyBlocks in blocks.items():
+				for blockTimestamps, sections in keyBlocks:
+					self.indexWriters[key].appendSections(blockTimestamps, sections)
+			self.busy += busy
+			self.indexed += len(timestamps)
+			self.lastIndexed = timestamps[-1]
+			appended += 1
+		return appended
+
+	def done(self):
+		return self.ended and len(self.diffs) == 0 and len(self.running) == 0
+
+	def close(self):
+		for writer in self.indexWriters.values():
+			writer.close()
+
+	# Seconds of video indexed, and how far indexing is behind the camera (for live cameras, or real time for files)
+	def toStr(self):
+		elapsed = time.time() - self.started
+		indexedTime = self.lastIndexed / float(self.fps)
+		if self.error is not None:
+			return "{:>12}: {:>6} diffs indexed, failed: {}".format(self.name, self.indexed, self.error)
+		return "{:>12}: {:>6} diffs indexed, {:>8.1f} s of video, {:>6.1f}x real time, lag {:>6.1f} s, {:>3} queued, {} running".format(self.name, self.indexed, indexedTime, indexedTime/max(elapsed, 1e-9), max(0.0, elapsed - indexedTime), self.queue.qsize() + len(self.diffs), len(self.running))
+
+
+###############################
+# Do the magic!
+cameras = [Camera(config) for config in json.load(open(args.config))]
+if len(cameras) == 0:
+	print "No cameras in {}".format(args.config)
+	sys.exit(0)
+
+pool = Pool(processes=args.processes)
+for camera in cameras:
+	camera.start()
+
+# Keep the pool busy, but don't queue more jobs than can start soon
+maxRunning = 2*args.processes
+
+tt = time.time()
+lastReport = tt
+first = 0
+try:
+	while not all(camera.done() for camera in cameras):
+		progress = sum(camera.collect() for camera in cameras)
+
+		# Round robin over the cameras, each submitting at most one job per round. The camera asked first changes every round.
+		for k in range(0, len(cameras)):
+			camera = cameras[(first + k) % len(cameras)]
+			if sum(len(c.running) for c in cameras) >= maxRunning:
+				break
+			if len(camera.running) >= args.inflight:
+				continue
+			job = camera.takeJob()
+			if job is not None:
+				diffs, timestamps = job
+				camera.running.append((timestamps, pool.apply_async(pipeline.indexBlocks, (diffs, timestamps, camera.regSizes, camera.encodings, cols))))
+				progress += 1
+		first = (first + 1) % len(cameras)
+
+		if time.time() - lastReport >= args.report:
+			lastReport = time.time()
+			for camera in cameras:
+				print camera.toStr()
+			print "Workers busy: {:.1f}%".format(100.0 * sum(camera.busy for camera in cameras) / ((lastReport - tt) * args.processes))
+
+		if progress == 0:
+			time.sleep(0.005)
+except KeyboardInterrupt:
+	print "Stopped"
+	pool.terminate()
+except:
+	# A job failed: stop the other jobs, and keep the blocks appended so far
+	pool.terminate()
+	pool.join()
+	for camera in cameras:
+		camera.close()
+	raise
+else:
+	pool.close()
+pool.join()
+
+for camera in cameras:
+	camera.close()
+	print camera.toStr()
+timeTotal = time.time() - tt
+print "Indexed {} diffs from {} cameras in {:.2f} s. Workers busy: {:.1f}%".format(sum(camera.indexed for camera in cameras), len(cameras), timeTotal, 100.0 * sum(camera.busy for camera in cameras) / (timeTotal * args.processes))
+failed = [camera.name for camera in cameras if camera.error is not None]
+if len(failed) > 0:
+	print "Cameras that failed: {}".format(", ".join(failed))
+	sys.exit(1)
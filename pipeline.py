@@ -0,0 +1,375 @@
+import numpy as np
+import fileops
+import histindex
+import cv2
+import os
+import time
+import json
+import threading
+
+# Building blocks for pipelines that decode diffs from a video, and write them to disk or directly into an index.
+
+# Put on a queue by a producer when there is no more data
+endOfStream = None
+
+# Read the video opened by capture frame by frame, as in vid2diff.py, and put a (count, diff) pair
+# on outQueue for every diffInterval frames. count is the number of the last video frame used for the diff.
+# Diffs are gray-scale, obtained from RGB by conversion to YUV and keeping Y channel. If size (width, height) is given,
+# frames are scaled to it before diffing.
+# outQueue should be bounded, so decoding blocks when the consumer can't keep up.
+# endOfStream is put on outQueue when the video has been read. If live is True, capture is a live stream (e.g. a camera)
+# which is read until it fails.
+# If decoding fails (e.g. the first frame can't be read), the exception is put on outQueue before endOfStream,
+# so the consumer can raise it (see raiseStreamError).
+def decodeDiffs(capture, diffInterval, outQueue, live=False, size=None):
+	try:
+		# Detect length of video to stop it looping (OS X can't detect the end of file)
+		frames = capture.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT)
+		if live:
+			frames = float("inf")
+
+		count = 1
+		success, first = capture.read()
+		if not success:
+			raise IOError("Can't read the first frame of the video")
+		grayFirst = grayFrame(first, size)
+		while count <= frames:
+			# Skip a number of frames (until the next read will be on the diffInterval)
+			while(count < frames and count % diffInterval != (diffInterval-1)):
+				capture.grab() # Only grab, don't read. Allows us to skip decoding for the frame
+				count += 1
+
+			count += 1
+			success, second = capture.read()
+			if not success:
+				break
+			graySecond = grayFrame(second, size)
+
+			outQueue.put((count, cv2.absdiff(graySecond, grayFirst)))
+			grayFirst = graySecond
+	except Exception as e:
+		outQueue.put(e)
+	finally:
+		outQueue.put(endOfStream)
+
+# Raise the exception a producer put on a queue in place of data (see decodeDiffs), if item is one
+def raiseStreamError(item):
+	if isinstance(item, Exception):
+		raise item
+
+# Return a BGR video frame in gray-scale, scaled to size (width, height) if it is given
+def grayFrame(frame, size=None):
+	gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+	if size is not None and (len(gray[0]), len(gray)) != tuple(size):
+		gray = cv2.resize(gray, tuple(size), interpolation=cv2.INTER_AREA)
+	return gray
+
+
+# Counts the items processed by a pipeline stage and the time spent processing them,
+# so stages can be compared to find the bottleneck. Safe to update from several threads.
+class StageCounter:
+	def __init__(self, name):
+		self.name = name
+		self.items = 0
+		self.busy = 0.0
+		self.lock = threading.Lock()
+
+	def add(self, items, busy):
+		with self.lock:
+			self.items += items
+			self.busy += busy
+
+	# Items per second of time spent in the stage (not per second of wall time)
+	def rate(self):
+		if self.busy == 0:
+			return 0.0
+		return self.items / self.busy
+
+	def toStr(self):
+		return "{:>8}: {:>6} items, {:>8.2f} s busy, {:>8.1f} items/s".format(self.name, self.items, self.busy, self.rate())
+
+
+# Gray frames shared with worker processes, as a (slots, height, width) view of a RawArray.
+# Set in each worker by initSharedFrames, so frames are passed to workers by slot index instead of being pickled.
+sharedFrames = None
+
+# Create a RawArray able to hold slots gray frames of the given size. Must be created before the worker pool.
+def createSharedFrames(slots, height, width):
+	from multiprocessing.sharedctypes import RawArray
+	return RawArray('B', slots*height*width)
+
+# Return a numpy (slots, height, width) view of a RawArray created by createSharedFrames.
+def sharedFramesView(raw, slots, height, width):
+	return np.frombuffer(raw, dtype=np.ubyte).reshape((slots, height, width))
+
+# Pool initializer for workers using diffSharedFrames.
+def initSharedFrames(raw, slots, height, width):
+	global sharedFrames
+	sharedFrames = sharedFramesView(raw, slots, height, width)
+
+# Worker: diff the gray frames in two slots of sharedFrames and write the diff to path/name.
+# If packOffset is given, path/name is a diff pack and the diff is written to the space reserved for it at packOffset.
+# Return the time spent diffing and writing, and the number of bytes written.
+def diffSharedFrames(firstSlot, secondSlot, path, name, packOffset=None):
+	st = time.time()
+	diff = cv2.absdiff(sharedFrames[secondSlot], sharedFrames[firstSlot])
+	diffTime = time.time() - st
+
+	st = time.time()
+	if packOffset is None:
+		size = fileops.diffToFile(path, name, diff)
+	else:
+		size = fileops.diffToPackAt(os.path.join(path, name), packOffset, diff)
+	writeTime = time.time() - st
+	return diffTime, writeTime, size
+
+# Read the video opened by capture as decodeDiffs, but convert every frame used for a diff to gray directly into
+# a slot of the (slots, height, width) array frames. A free slot is taken from freeSlots (blocking until one is released),
+# and (count, slot) is put on outQueue. first is the first frame of the video, already read from capture.
+# Time spent grabbing, decoding and converting is recorded in counter. endOfStream is put on outQueue when done.
+def decodeToSlots(capture, diffInterval, first, frames, freeSlots, outQueue, counter):
+	frameCount = capture.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT)
+
+	count = 1
+	frame = first
+	while True:
+		slot = freeSlots.get()
+		st = time.time()
+		frames[slot] = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+		counter.add(1, time.time() - st)
+		outQueue.put((count, slot))
+
+		if count > frameCount:
+			break
+
+		st = time.time()
+		# Skip a number of frames (until the next read will be on the diffInterval)
+		while(count < frameCount and count % diffInterval != (diffInterval-1)):
+			capture.grab() # Only grab, don't read. Allows us to skip decoding for the frame
+			count += 1
+
+		count += 1
+		success, frame = capture.read()
+		counter.add(0, time.time() - st)
+		if not success:
+			break
+
+	outQueue.put(endOfStream)
+
+
+# Name of the file in the output directory of a camera caching the wavelet chosen for it (see chooseWavelet)
+waveletCache = "wavelet.json"
+
+# Return the (name, budget) wavelet of the wavelet layout for the camera whose index files are written to path, chosen on
+# the region histograms of the list of diffs at every region size (see fileops.selectWavelet), or None if no layout in
+# layouts is a wavelet layout. The choice is cached in path/waveletCache, so it is made once per camera and kept when
+# indexing is restarted.
+def chooseWavelet(path, diffs, regSizes, layouts, colors=256):
+	if not any(layout in fileops.waveletLayouts for layout in layouts):
+		return None
+	cacheName = os.path.join(path, waveletCache)
+	if os.path.isfile(cacheName):
+		name, budget = json.load(open(cacheName))
+		return str(name), budget
+
+	data = np.asarray(diffs)
+	hists = np.concatenate([fileops.regionsFromDataBatch(data, regSize, colors).reshape((-1, colors)) for regSize in regSizes])
+	wavelet = fileops.selectWavelet(hists)
+	with open(cacheName, "w") as of:
+		json.dump(list(wavelet), of)
+	return wavelet
+
+
+# Histograms diffs as they arrive and writes compressed index files in the same directory structure as diffcompress.py:
+# path/frames_N/regSize/layout/compression/<diff name>.hist.layout.compression
+# A file is written as soon as N histograms have been collected for it. The histogram data only exists in memory.
+# If fps is given, every index variation is also written as a single index file (see histindex.indexName), with summed-area tables
+# for the threshold values in satLevels, and histograms quantized to binEdges (see histindex.IndexWriter). wavelet is the
+# (name, budget) of wavelet layouts (see fileops.histLayoutArray), or "auto" to choose it on the first diff (see chooseWavelet).
+# Call close() when done.
+class DiffIndexer:
+	def __init__(self, path, regSizes, frames, layouts, compressions, colors=256, fps=None, satLevels=None, binEdges=None, wavelet=None):
+		self.path = path
+		self.regSizes = regSizes
+		self.frames = frames
+		self.layouts = layouts
+		self.compressions = compressions
+		self.colors = colors
+		self.fps = fps
+		self.satLevels = satLevels
+		self.binEdges = binEdges
+		self.wavelet = wavelet
+		self.lastName = None
+		self.filesWritten = 0
+		self.indexWriters = {}
+
+		# Histograms (and their timestamps) not yet written, per number of frames per file and region size
+		self.histograms = {}
+		self.timestamps = {}
+		for i in frames:
+			self.histograms[i] = {}
+			self.timestamps[i] = {}
+			for regSize in regSizes:
+				self.histograms[i][regSize] = []
+				self.timestamps[i][regSize] = []
+
+	# Open the index files, once the size of the diffs is known
+	def openIndexes(self, width, height):
+		for i in self.frames:
+			for regSize in self.regSizes:
+				fileops.ensureDir(os.path.join(self.path, "frames_"+str(i), str(regSize)))
+				for layout in self.layouts:
+					for compression in self.compressions:
+						self.indexWriters[(i, regSize, layout, compression)] = histindex.IndexWriter(histindex.indexName(self.path, i, regSize, layout, compression), width, height, regSize, layout, compression, self.fps, i, self.colors, satLevels=self.satLevels, binEdges=self.binEdges, wavelet=self.wavelet)
+
+	# Add the diff with the given (diff file) name and timestamp (frame number) to the index
+	def add(self, name, diff, timestamp):
+		if self.wavelet == "auto":
+			self.wavelet = chooseWavelet(self.path, [diff], self.regSizes, self.layouts, self.colors)
+		if self.fps is not None and len(self.indexWriters) == 0:
+			self.openIndexes(len(diff[0]), len(diff))
+
+		self.lastName = name
+		pyramidHists = fileops.regionPyramidFromData(diff, self.regSizes, self.colors)
+		for regSize in self.regSizes:
+			for i in self.frames:
+				self.histograms[i][regSize].append(pyramidHists[regSize])
+				self.timestamps[i][regSize].append(timestamp)
+				if len(self.histograms[i][regSize]) == i:
+					self.writeFile(i, regSize, name)
+
+	# Write all histograms collected for frames_i/regSize to a file named after the last diff in it
+	def writeFile(self, i, regSize, name):
+		cp = os.path.join(self.path, "frames_"+str(i), str(regSize))
+		for layout in self.layouts:
+			bytes_read = fileops.histToBytesLayout(self.histograms[i][regSize], layout, self.wavelet)
+			fileops.compressBytes(os.path.join(cp, layout), name+".hist."+layout, bytes_read, self.compressions, False)
+			self.filesWritten += 1
+			for compression in self.compressions:
+				if (i, regSize, layout, compression) in self.indexWriters:
+					self.indexWriters[(i, regSize, layout, compression)].appendBlock(self.timestamps[i][regSize], self.histograms[i][regSize])
+		self.histograms[i][regSize] = []
+		self.timestamps[i][regSize] = []
+
+	# Write files for all histograms that haven't been written yet (files hold fewer than N frames)
+	def flush(self):
+		for i in self.frames:
+			for regSize in self.regSizes:
+				if len(self.histograms[i][regSize]) > 0:
+					self.writeFile(i, regSize, self.lastName)
+
+	# Flush, and close the index files
+	def close(self):
+		self.flush()
+		for writer in self.indexWriters.values():
+			writer.close()
+
+
+# Worker: histogram a (frames, height, width) array of diffs with the given timestamps at all regSizes, and encode the
+# histograms as index blocks of N frames (histindex.blockSections), where encodings is a dictionary from
+# (N, regSize, layout, compression) to the encoding of the index (histindex.IndexWriter.encoding).
+# Return a dictionary with the same keys and lists of (timestamps, sections) blocks as values (to be appended with
+# histindex.IndexWriter.appendSections), and the time spent.
+def indexBlocks(diffs, timestamps, regSizes, encodings, colors=256):
+	st = time.time()
+	pyramidHists = fileops.regionPyramidFromData(diffs, regSizes, colors)
+	blocks = {}
+	for key, encoding in encodings.items():
+		i, regSize = key[0], key[1]
+		blocks[key] = [(timestamps[s:s+i], histindex.blockSections(pyramidHists[regSize][s:s+i], *encoding)) for s in range(0, len(timestamps), i)]
+	return blocks, time.time() - st
+
+
+# Histograms diffs as they arrive from a live camera and appends them to index files (see histindex.indexName), written
+# with the given frames per block. A block is appended as soon as it holds N frames, or when its oldest frame has waited
+# maxLatency seconds (see flushDue), so frames can be queried (see histindex.IndexReader.refresh) at most maxLatency seconds
+# after they arrived, while the index is still being written. wavelet is as in DiffIndexer. Call close() when done.
+class LiveIndexer:
+	def __init__(self, path, regSizes, frames, layouts, compressions, fps, maxLatency, colors=256, satLevels=None, binEdges=None, wavelet=None):
+		self.path = path
+		self.regSizes = regSizes
+		self.frames = frames
+		self.layouts = layouts
+		self.compressions = compressions
+		self.fps = fps
+		self.maxLatency = maxLatency
+		self.colors = colors
+		self.satLevels = satLevels
+		self.binEdges = binEdges
+		self.wavelet = wavelet
+		self.lastGray = None
+		self.blocksWritten = 0
+		self.indexWriters = {}
+
+		# Histograms and timestamps not yet written, and the time the first of them arrived, per number of frames per block and region size
+		self.pending = {}
+		for i in frames:
+			for regSize in regSizes:
+				self.pending[(i, regSize)] = ([], [], None)
+
+	# Open the index files, once the size of the diffs is known
+	def openIndexes(self, width, height):
+		for i in self.frames:
+			for regSize in self.regSizes:
+				fileops.ensureDir(os.path.join(self.path, "frames_"+str(i), str(regSize)))
+				for layout in self.layouts:
+					for compression in self.compressions:
+						self.indexWriters[(i, regSize, layout, compression)] = histindex.IndexWriter(histindex.indexName(self.path, i, regSize, layout, compression), width, height, regSize, layout, compression, self.fps, i, self.colors, satLevels=self.satLevels, binEdges=self.binEdges, wavelet=self.wavelet)
+
+	# Add a diff with the given timestamp (frame number). Timestamps must increase.
+	def add(self, diff, timestamp):
+		if self.wavelet == "auto":
+			self.wavelet = chooseWavelet(self.path, [diff], self.regSizes, self.layouts, self.colors)
+		if len(self.indexWriters) == 0:
+			self.openIndexes(len(diff[0]), len(diff))
+
+		now = time.time()
+		pyramidHists = fileops.regionPyramidFromData(diff, self.regSizes, self.colors)
+		for (i, regSize), (hists, timestamps, since) in self.pending.items():
+			hists.append(pyramidHists[regSize])
+			timestamps.append(timestamp)
+			self.pending[(i, regSize)] = (hists, timestamps, since if since is not None else now)
+			if len(hists) == i:
+				self.writeBlock(i, regSize)
+
+	# Add a raw (BGR or gray) video frame with the given timestamp. It is diffed with the previous frame added.
+	def addFrame(self, frame, timestamp):
+		gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+		if self.lastGray is not None:
+			self.add(cv2.absdiff(gray, self.lastGray), timestamp)
+		self.lastGray = gray
+
+	# Append the pending histograms for frames_i/regSize as a block to its index files
+	def writeBlock(self, i, regSize):
+		hists, timestamps, since = self.pending[(i, regSize)]
+		for layout in self.layouts:
+			for compression in self.compressions:
+				self.indexWriters[(i, regSize, layout, compression)].appendBlock(timestamps, hists)
+		self.blocksWritten += 1
+		self.pending[(i, regSize)] = ([], [], None)
+
+	# Write the pending histograms that have waited maxLatency seconds as (partial) blocks.
+	# Return the number of seconds until the next pending histograms are due, or None if there are none.
+	def flushDue(self):
+		now = time.time()
+		due = None
+		for (i, regSize), (hists, timestamps, since) in self.pending.items():
+			if since is None:
+				continue
+			if now - since >= self.maxLatency:
+				self.writeBlock(i, regSize)
+			else:
+				due = min(due, since + self.maxLatency - now) if due is not None else since + self.maxLatency - now
+		return due
+
+	# Write all pending histograms as (partial) blocks
+	def flush(self):
+		for (i, regSize), (hists, timestamps, since) in self.pending.items():
+			if len(hists) > 0:
+				self.writeBlock(i, regSize)
+
+	# Flush, and close the index files
+	def close(self):
+		self.flush()
+		for writer in self.indexWriters.values():
+			writer.close()
@@ -1,7 +1,13 @@
 import numpy as np
 import fileops
+import pipeline
 import cv2
 import os
+import time
+import argparse
+import threading
+import Queue as queue
+from multiprocessing import Pool, cpu_count
 
 # General idea:
 # - Read video file frame by frame.
@@ -9,6 +15,8 @@ import os
 # - Calculate diff-image by subtracting frames and write it to disk.
 # - Output diffs are written to tests/diff-${inFileName}
 # - Diffs are gray-scale, obtained from RGB by conversion to YUV and keeping Y channel
+# - With --pipelined, decoding runs on its own thread and diffing/writing on a pool of worker processes.
+#   Gray frames are passed to the workers in shared memory slots, so they are never pickled.
 
 # Name of video file in tests/
 inFileName="HALLWAY_A.mpg"
@@ -20,6 +28,36 @@ inDir="/Users/sorenvind/Documents/work/research/MotionDetection/HistogramCompres
 diffInterval=10
 
 
+# Name of the diff pack all diffs are written to with --pack
+packName = "diffs.diffpack"
+
+# Number of worker processes diffing and writing frames in pipelined mode
+workers = cpu_count()
+
+# Maximum number of decoded frames waiting to be diffed in pipelined mode
+queueSize = 16
+
+
+#####################################################
+##### HERE BE PARSING OF COMMAND LINE ARGUMENTS #####
+#####################################################
+
+parser = argparse.ArgumentParser(description='Arguments')
+parser.add_argument('--file', dest='file', action='store', default=inFileName, help='name of the video file')
+parser.add_argument('--dir', dest='dir', action='store', default=inDir, help='absolute path of the directory containing the video file')
+parser.add_argument('--interval', dest='interval', type=int, action='store', default=diffInterval, help='the number of frames between diffs')
+parser.add_argument('--headless', dest='headless', action='store_true', help='do not show difference images as they are processed')
+parser.add_argument('--pack', dest='pack', action='store_true', help='append all diffs to a single diff pack file instead of writing a file per diff')
+parser.add_argument('--pipelined', dest='pipelined', action='store_true', help='decode on a separate thread and diff/write on a pool of workers (implies --headless)')
+parser.add_argument('--workers', dest='workers', type=int, action='store', default=workers, help='the number of worker processes in pipelined mode')
+parser.add_argument('--queue', dest='queue', type=int, action='store', default=queueSize, help='the maximum number of decoded frames waiting to be diffed in pipelined mode')
+
+args = parser.parse_args()
+inFileName = args.file
+inDir = args.dir
+diffInterval = args.interval
+
+
 ###############################
 # Do the magic!
 outputPath=os.path.join(inDir, "diff-"+inFileName+"_{}".format(diffInterval))
@@ -33,39 +71,165 @@ frames = capture.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT)
 fps = capture.get(cv2.cv.CV_CAP_PROP_FPS)
 
 totalSize = 0
-count = 1
-success, first = capture.read()
+pack = None
+if args.pipelined:
+	success, first = capture.read()
+	height = len(first)
+	width = len(first[0])
+	if args.pack:
+		pack = fileops.DiffPackWriter(outputPath, packName, height, width)
 
-# Converts to YUV while only keeping Y channel
-grayFirst = cv2.cvtColor(first, cv2.COLOR_BGR2GRAY)
-while count <= frames:
-	# Ignore a number of reads (until the next read will be on the diffInterval)
-	while(count < frames and count % diffInterval != (diffInterval-1)):
-		capture.grab()
-		count += 1
+	# Every diff task holds two slots, and each frame is held by the main thread until its successor arrives.
+	# Slots are only released when no task needs them, so running out of slots stops decoding (backpressure).
+	slots = 2*args.workers + args.queue + 2
+	raw = pipeline.createSharedFrames(slots, height, width)
+	sharedFrames = pipeline.sharedFramesView(raw, slots, height, width)
+	pool = Pool(processes=args.workers, initializer=pipeline.initSharedFrames, initargs=(raw, slots, height, width))
 
-	count += 1	
-	success, second = capture.read()
-	graySecond = cv2.cvtColor(second, cv2.COLOR_BGR2GRAY)
+	freeSlots = queue.Queue()
+	for slot in range(0, slots):
+		freeSlots.put(slot)
+	slotRefs = [0]*slots
+	slotLock = threading.Lock()
+	sizes = []
+
+	def holdSlot(slot):
+		with slotLock:
+			slotRefs[slot] += 1
+
+	def releaseSlot(slot):
+		with slotLock:
+			slotRefs[slot] -= 1
+			if slotRefs[slot] == 0:
+				freeSlots.put(slot)
+
+	# Per-stage counters, to show which stage is the bottleneck
+	decodeCounter = pipeline.StageCounter("decode")
+	diffCounter = pipeline.StageCounter("diff")
+	writeCounter = pipeline.StageCounter("write")
+	waitCounter = pipeline.StageCounter("wait")
+
+	# Callback for a finished diff task: record timings and release the slots the task held
+	def diffDoneFact(firstSlot, secondSlot):
+		def diffDone(result):
+			diffTime, writeTime, size = result
+			diffCounter.add(1, diffTime)
+			writeCounter.add(1, writeTime)
+			sizes.append(size)
+			releaseSlot(firstSlot)
+			releaseSlot(secondSlot)
+		return diffDone
+
+	# Results of the diff tasks still running. A failed task never releases its slots, so results are checked
+	# while waiting for frames, and the first failure is raised instead of waiting for slots forever.
+	results = []
+	def checkResults():
+		for result in [result for result in results if result.ready()]:
+			results.remove(result)
+			result.get()
+
+	tt = time.time()
+	slotQueue = queue.Queue(maxsize=args.queue)
+	decoder = threading.Thread(target=pipeline.decodeToSlots, args=(capture, diffInterval, first, sharedFrames, freeSlots, slotQueue, decodeCounter))
+	decoder.daemon = True
+	decoder.start()
+
+	prevSlot = None
+	try:
+		while True:
+			st = time.time()
+			try:
+				item = slotQueue.get(timeout=1.0)
+			except queue.Empty:
+				waitCounter.add(0, time.time() - st)
+				checkResults()
+				continue
+			waitCounter.add(0, time.time() - st)
+			if item is pipeline.endOfStream:
+				break
+			count, slot = item
+			waitCounter.add(1, 0)
+			checkResults()
+
+			holdSlot(slot)
+			if prevSlot is not None:
+				holdSlot(prevSlot)
+				holdSlot(slot)
+				outName = fileops.diffFileName(height, width, fps/float(diffInterval), count)
+				if pack is None:
+					results.append(pool.apply_async(pipeline.diffSharedFrames, (prevSlot, slot, outputPath, outName), callback=diffDoneFact(prevSlot, slot)))
+				else:
+					# Diffs have a fixed size, so space for each is reserved in order and workers write them in parallel
+					results.append(pool.apply_async(pipeline.diffSharedFrames, (prevSlot, slot, outputPath, packName, pack.reserve(outName)), callback=diffDoneFact(prevSlot, slot)))
+				releaseSlot(prevSlot)
+			prevSlot = slot
+
+		if prevSlot is not None:
+			releaseSlot(prevSlot)
+		pool.close()
+		for result in results:
+			result.get()
+	except:
+		pool.terminate()
+		raise
+	pool.join()
+	decoder.join()
+	totalSize = sum(sizes)
+	timeTotal = time.time() - tt
+
+	# Throughput per stage. Diffing and writing run on all workers, decoding on a single thread.
+	print "Pipelined with {} workers, {} slots: {} diffs in {:.2f} s ({:.1f} diffs/s)".format(args.workers, slots, diffCounter.items, timeTotal, diffCounter.items/max(timeTotal, 1e-9))
+	for counter in [decodeCounter, diffCounter, writeCounter, waitCounter]:
+		print counter.toStr()
+	decodeRate = decodeCounter.rate()
+	workerRate = 0.0
+	if diffCounter.busy + writeCounter.busy > 0:
+		workerRate = args.workers * diffCounter.items / (diffCounter.busy + writeCounter.busy)
+	print "Bottleneck: {} (decode {:.1f} frames/s, workers {:.1f} diffs/s)".format("decode" if decodeRate < workerRate else "diff/write", decodeRate, workerRate)
+else:
+	count = 1
+	success, first = capture.read()
+
+	# Converts to YUV while only keeping Y channel
+	grayFirst = cv2.cvtColor(first, cv2.COLOR_BGR2GRAY)
+	while count <= frames:
+		# Ignore a number of reads (until the next read will be on the diffInterval)
+		while(count < frames and count % diffInterval != (diffInterval-1)):
+			capture.grab()
+			count += 1
+
+		count += 1	
+		success, second = capture.read()
+		if not success:
+			break
+		graySecond = cv2.cvtColor(second, cv2.COLOR_BGR2GRAY)
 
 	
-	# Absolute difference
-	diff = cv2.absdiff(graySecond, grayFirst)
-	
-	# Show difference images as they are processed
-	cv2.imshow("img", diff)
-	k=cv2.waitKey(1)
-	if k==27:
-		break
+		# Absolute difference
+		diff = cv2.absdiff(graySecond, grayFirst)
 	
-	# Write to file
-	outName = "diff_{}-{}_{:.1f}_{:04d}.bin".format(len(diff), len(diff[0]), fps/float(diffInterval), count) # diff_width-height_fps_count
-	totalSize += fileops.diffToFile(outputPath, outName, diff)
+		# Show difference images as they are processed
+		if not args.headless:
+			cv2.imshow("img", diff)
+			k=cv2.waitKey(1)
+			if k==27:
+				break
 	
-	# Write progress
-	print "Done generating diff {:>4}".format(count)
+		# Write to file
+		outName = fileops.diffFileName(len(diff), len(diff[0]), fps/float(diffInterval), count)
+		if args.pack:
+			if pack is None:
+				pack = fileops.DiffPackWriter(outputPath, packName, len(diff), len(diff[0]))
+			totalSize += pack.append(outName, diff)
+		else:
+			totalSize += fileops.diffToFile(outputPath, outName, diff)
 	
-	first = second
-	grayFirst = graySecond
+		# Write progress
+		print "Done generating diff {:>4}".format(count)
 	
+		first = second
+		grayFirst = graySecond
+
+if pack is not None:
+	pack.close()
 print "Written to {}: {} kB".format(outputPath, totalSize/1024)
@@ -0,0 +1,156 @@
+import numpy as np
+import fileops
+import compressors
+import pipeline
+import cv2
+import os
+import time
+import argparse
+import threading
+import Queue as queue
+
+# General idea:
+# - Decode video file frame by frame on a separate thread, creating diff-images as in vid2diff.py.
+# - Histogram the diffs and write compressed index files as diffcompress.py would, without storing diffs on disk.
+# - Decoding and indexing are connected by a bounded queue, so decoding waits when indexing falls behind.
+# - Index is written to tests/diff-${inFileName}_${diffInterval}/frames_N/..., where vid2diff.py writes its diffs.
+# - With --live, a live stream (e.g. a camera) is read until stopped, and only index files are written. Blocks are appended
+#   when they are full or when their oldest frame has waited --latency seconds, so the index can be queried while it grows.
+
+
+#####################################################
+###### HERE ARE THE OPTIONS THAT CAN BE CHANGED #####
+#####################################################
+
+# Name of video file in tests/
+inFileName="HALLWAY_A.mpg"
+
+# Input video file directory (HAS TO BE ABSOLUTE FOR cv2.VideoCapture TO WORK ON MAC OS X!)
+inDir="/Users/sorenvind/Documents/work/research/MotionDetection/HistogramCompression/tests"
+
+# The number of frames that should be between any diff-image. I.e. if 25fps and diffInterval=5, 5 diffs are created per second.
+diffInterval=10
+
+# Regions per direction
+regSizes = [4, 8, 16, 32]
+
+# Frames per file
+frames = [1, 10]
+
+# Layout we want to store the histograms with
+layouts = ["linear"]
+
+# Compression algorithms to write the index with
+compressions = ["zlib-6"]
+
+# Wavelet and number of coefficients kept per region histogram (budget) with the lossy wavelet layout (see fileops.waveletLayouts)
+wavelet = "haar"
+waveletBudget = 16
+
+# Maximum number of diffs waiting to be indexed
+queueSize = 16
+
+# Maximum number of seconds a diff waits before it is written to the index in live mode
+maxLatency = 5.0
+
+# Cols = Different pixel values
+cols = 256
+
+
+#####################################################
+##### HERE BE PARSING OF COMMAND LINE ARGUMENTS #####
+#####################################################
+
+parser = argparse.ArgumentParser(description='Arguments')
+parser.add_argument('--file', dest='file', action='store', default=inFileName, help='name of the video file')
+parser.add_argument('--dir', dest='dir', action='store', default=inDir, help='absolute path of the directory containing the video file')
+parser.add_argument('--interval', dest='interval', type=int, action='store', default=diffInterval, help='the number of frames between diffs')
+parser.add_argument('--regions', dest='regions', type=int, action='store', default=regSizes, nargs='+', help='a list of regions per direction')
+parser.add_argument('--frames', dest='frames', type=int, action='store', default=frames, nargs='+', help='a list of # frames that should be stored per compressed file')
+parser.add_argument('--layouts', dest='layouts', choices=["linear", "binned", "reg-linear", "reg-binned", "bin-delta", "frame-delta", "frame-xor", "varint", "frame-varint", "truncated", "truncated-delta", "wavelet"], action='store', default=layouts, nargs='+', help='a list of layouts names in which the regions should be stored')
+parser.add_argument('--compressions', dest='compressions', action='store', default=compressions, nargs='+', help='a list of codecs to write the index with, e.g. zlib-6 lzma zstd-3 (see compressors.py)')
+parser.add_argument('--wavelet', dest='wavelet', action='store', default=wavelet, help='the wavelet (see pywt.wavelist) of the wavelet layout, or auto to choose the wavelet and budget on the first diff (cached in the output directory)')
+parser.add_argument('--budget', dest='budget', type=int, action='store', default=waveletBudget, help='the number of wavelet coefficients kept per region histogram with the wavelet layout')
+parser.add_argument('--queue', dest='queue', type=int, action='store', default=queueSize, help='the maximum number of decoded diffs waiting to be indexed')
+parser.add_argument('--index', dest='index', action='store_true', help='also write each index variation as a single index file (frames_N/regions/layout.compression.hidx)')
+parser.add_argument('--satlevels', dest='satlevels', type=int, action='store', default=None, nargs='+', help='threshold values to store summed-area tables for in index files, for fast rectangular queries')
+parser.add_argument('--binedges', dest='binedges', type=int, action='store', default=None, nargs='+', help='threshold values to quantize the histograms in index files to; queries are exact at these values and bounded between them')
+parser.add_argument('--live', dest='live', action='store_true', help='index a live stream until stopped, writing only index files that can be queried while they are written')
+parser.add_argument('--stream', dest='stream', action='store', default=None, help='URL or device number of the live stream to read in place of the video file (--file then only names the output directory)')
+parser.add_argument('--latency', dest='latency', type=float, action='store', default=maxLatency, help='the maximum number of seconds a diff waits before it is written to the index in live mode')
+parser.add_argument('--fps', dest='fps', type=float, action='store', default=None, help='the frame rate of the video, if it is not reported correctly by the stream')
+parser.add_argument('--writediffs', dest='writediffs', action='store_true', help='also write the diff files to disk (for debugging)')
+
+args = parser.parse_args()
+for codec, reason in compressors.unavailable(args.compressions).items():
+	parser.error("codec {} can't be used: {}".format(codec, reason))
+for codec in args.compressions:
+	if compressors.isTrained(codec):
+		parser.error("codec {} needs a trained dictionary, which only diffcompress.py trains".format(codec))
+
+
+###############################
+# Do the magic!
+outputPath=os.path.join(args.dir, "diff-"+args.file+"_{}".format(args.interval))
+fileops.ensureDir(outputPath)
+
+inputPath=os.path.join(args.dir, args.file)
+if args.stream is not None:
+	inputPath = int(args.stream) if args.stream.isdigit() else args.stream
+capture = cv2.VideoCapture(inputPath)
+fps = args.fps if args.fps is not None else capture.get(cv2.cv.CV_CAP_PROP_FPS)
+
+# Decode on a separate thread. cv2 releases the GIL while decoding, so decoding and histogramming overlap.
+diffQueue = queue.Queue(maxsize=args.queue)
+decoder = threading.Thread(target=pipeline.decodeDiffs, args=(capture, args.interval, diffQueue, args.live))
+decoder.daemon = True
+decoder.start()
+
+wavelet = "auto" if args.wavelet == "auto" else (args.wavelet, args.budget)
+if args.live:
+	indexer = pipeline.LiveIndexer(outputPath, args.regions, args.frames, args.layouts, args.compressions, fps, args.latency, cols, args.satlevels, args.binedges, wavelet)
+else:
+	indexer = pipeline.DiffIndexer(outputPath, args.regions, args.frames, args.layouts, args.compressions, cols, fps if args.index else None, args.satlevels, args.binedges, wavelet)
+
+tt = time.time()
+diffCount = 0
+try:
+	while True:
+		# In live mode, wake up when pending diffs are due to be written even if no new diffs arrive
+		timeout = None
+		if args.live:
+			due = indexer.flushDue()
+			timeout = due if due is not None else args.latency
+		try:
+			item = diffQueue.get(timeout=timeout)
+		except queue.Empty:
+			continue
+		if item is pipeline.endOfStream:
+			break
+		pipeline.raiseStreamError(item)
+		count, diff = item
+		diffCount += 1
+
+		outName = fileops.diffFileName(len(diff), len(diff[0]), fps/float(args.interval), count)
+		if args.writediffs:
+			fileops.diffToFile(outputPath, outName, diff)
+
+		if args.live:
+			indexer.add(diff, count)
+			indexer.flushDue()
+		else:
+			indexer.add(outName, diff, count)
+
+		# Write progress
+		print "Done indexing diff {:>4}".format(count)
+except KeyboardInterrupt:
+	print "Stopped"
+finally:
+	indexer.close()
+
+timeTotal = time.time() - tt
+if args.live:
+	print "Indexed {} diffs to {} blocks in {}: {:.2f} s ({:.1f} diffs/s)".format(diffCount, indexer.blocksWritten, outputPath, timeTotal, diffCount/max(timeTotal, 1e-9))
+else:
+	decoder.join()
+	print "Indexed {} diffs to {} files in {}: {:.2f} s ({:.1f} diffs/s)".format(diffCount, indexer.filesWritten, outputPath, timeTotal, diffCount/max(timeTotal, 1e-9))
@@ -1,7 +1,14 @@
 import numpy as np
 import math as math
 import pywt as pywt
-import copy as copy
+import Queue as queue
+import matplotlib.pyplot as plt
+import mischist
+import fileops
+
+# Experiments with lossy wavelet compression of cumulative histograms, plotting the best compressions found per region.
+# The wavelet layout (see fileops.waveletLayouts) stores histograms this way in indexes, with a fixed wavelet and budget,
+# which selectCompressions chooses for all regions at once.
 
 
 class Comp:
@@ -20,11 +27,10 @@ class Comp:
 
 
 # Given a diffstring (of two cumulative histograms), calculate some quality measure
-# Measure consist of difference between a number of more or less arbitrary points
-# Thus, lower quality is better.
+# Measure consist of difference between a number of more or less arbitrary points (see fileops.qualityValues)
+# Thus, lower quality is better. diff may also be an array of diffstrings (last axis), giving an array of qualities.
 def calculateQuality(diff):
-	qual = diff[4] + diff[9] + diff[29] + diff[99]
-	return qual
+	return fileops.histQuality(diff)
 
 
 
@@ -97,6 +103,29 @@ def createCompressions(hist, cumHist, buckets, plot, log, coord, plotBreakFracti
 	# return classification
 	return classify
 
+# Batched version of createCompressions: choose one wavelet and number of coefficients (budget) for all (..., colors)
+# cumulative histograms cumHists of a frame (or a sample of frames) at once, with one decomposition and reconstruction
+# of all histograms per wavelet and vectorized quality scoring (see fileops.selectWavelet). If plot, the compression
+# of every histogram (with its coord, e.g. "(i, j)") is plotted. Return the (wavelet, budget) chosen.
+def selectCompressions(cumHists, coords, plot, log, wavelets=None, budgets=None):
+	wavelet, budget = fileops.selectWavelet(cumHists, wavelets, budgets)
+	if not plot and not log:
+		return wavelet, budget
+
+	cumHists = np.asarray(cumHists)
+	stack = cumHists.reshape((1, -1, cumHists.shape[-1]))
+	stored = fileops.waveletArray(stack, (wavelet, budget)).tobytes()
+	recCumHists = fileops.waveletFromBytes(stored, stack.shape[1], stack.shape[2], stack.dtype)[0][0].astype(np.int64)
+	diffs = np.absolute(stack[0] - recCumHists)
+	qualities = calculateQuality(diffs)
+	for k in range(0, len(diffs)):
+		if log:
+			print "Region "+coords[k]+" Classify (max 10): "+str(classifyHist(stack[0][k].astype(np.float64), 10))+" Quality: "+str(qualities[k])
+		if plot:
+			thisSol = Comp(np.diff(stack[0][k]), np.diff(recCumHists[k]), diffs[k], qualities[k], "wave ("+wavelet+")", "budget ("+str(budget)+")", "size: "+str(len(stored))+" bytes for all regions", coords[k])
+			thisSol.plot(plt)
+	return wavelet, budget
+
 # Function for generating a wavelet compression.
 # cumHist is the cumulative histogram, wavelet is the wavelet to use, compression is the number of coefficients to store
 def generateCompression(cumHist, wavelet, compression):
@@ -130,8 +159,8 @@ def generateCompression(cumHist, wavelet, compression):
 # Return the new vectors, and a length-vector for restoring original vectors
 def reduceVectors(coeffs, threshold):
 	# For each detail coefficient vector, remove trailing values with equal value
-	red = copy.deepcopy(coeffs)
-	lengths = np.zeros(len(coeffs))
+	red = [np.copy(detail) for detail in coeffs]
+	lengths = np.zeros(len(coeffs), dtype=int)
 	for i in range(0,len(coeffs)):
 		detail = coeffs[i]
 		lengths[i] = int(len(detail))